@@ -0,0 +1,117 @@
+import os
+import math
+from datetime import datetime, timezone
+
+# The forecasts that were served are kept in a ring buffer per model (slot = target bucket % slots) until an actual
+# value of their target bucket is ingested, the error is then folded into running sums and EWMAs per horizon,
+# so the statistics never need the metrics table to be scanned.
+forecast_log_step = int(os.getenv("FORECAST_LOG_STEP_SECONDS", "60"))
+forecast_log_slots = int(os.getenv("FORECAST_LOG_SLOTS", "1440"))
+error_alpha = float(os.getenv("FORECAST_ERROR_ALPHA", "0.05"))
+# horizons with fewer joined forecasts are not used for the drift
+drift_min_count = int(os.getenv("FORECAST_DRIFT_MIN_COUNT", "30"))
+
+# upper bounds of the horizon buckets in seconds, the last one catches the rest
+horizon_buckets = [300, 900, 3600, 6 * 3600, 24 * 3600, 2**31 - 1]
+
+record_forecast_q = ''' INSERT INTO forecasts(name, slot, bucket, horizon, yhat) VALUES(?,?,?,?,?)
+            ON CONFLICT(name, slot) DO
+            UPDATE SET bucket=excluded.bucket, horizon=excluded.horizon, yhat=excluded.yhat '''
+
+pending_range_q = ''' SELECT MIN(bucket), MAX(bucket) FROM forecasts WHERE name = ? '''
+
+get_forecast_q = ''' SELECT horizon, yhat FROM forecasts WHERE name = ? AND slot = ? AND bucket = ? '''
+
+delete_forecast_q = ''' DELETE FROM forecasts WHERE name = ? AND slot = ? '''
+
+update_errors_q = ''' INSERT INTO forecast_errors(name, horizon, count, sum_error, sum_abs, sum_sq, sum_actual, ewma_abs, ewma_actual, updated)
+                VALUES(:name, :horizon, 1, :error, :abs, :sq, :actual, :abs, :actual, :updated)
+            ON CONFLICT(name, horizon) DO
+            UPDATE SET
+                count=count + 1,
+                sum_error=sum_error + excluded.sum_error,
+                sum_abs=sum_abs + excluded.sum_abs,
+                sum_sq=sum_sq + excluded.sum_sq,
+                sum_actual=sum_actual + excluded.sum_actual,
+                ewma_abs=ewma_abs + :alpha * (excluded.ewma_abs - ewma_abs),
+                ewma_actual=ewma_actual + :alpha * (excluded.ewma_actual - ewma_actual),
+                updated=excluded.updated '''
+
+get_errors_q = ''' SELECT horizon, count, sum_error, sum_abs, sum_sq, sum_actual, ewma_abs, ewma_actual, updated
+                FROM forecast_errors WHERE name = ? ORDER BY horizon '''
+
+# the statistics are of the current model, they start over after each fit
+reset_accuracy_q = [
+    ''' DELETE FROM forecasts WHERE name = ? ''',
+    ''' DELETE FROM forecast_errors WHERE name = ? ''',
+]
+
+def horizon_bucket(seconds: float) -> int:
+    return next(b for b in horizon_buckets if seconds <= b)
+
+def record(con, name, targets: list[int], yhats: list[float], now: int) -> int:
+    # only the future within the ring buffer is recorded, targets are epoch seconds.
+    # a target further ahead would take the slot of a pending nearer forecast
+    rows = []
+    for target, yhat in zip(targets, yhats):
+        if target <= now or target - now >= forecast_log_slots * forecast_log_step:
+            continue
+        bucket = target // forecast_log_step
+        rows.append((name, bucket % forecast_log_slots, bucket, horizon_bucket(target - now), float(yhat)))
+    con.executemany(record_forecast_q, rows)
+    return len(rows)
+
+def join_actuals(con, name, timestamps, values, now: int) -> int:
+    # matches the actual values with the pending forecasts of their buckets, the first value of a bucket wins
+    lo, hi = con.execute(pending_range_q, (name,)).fetchone()
+    if lo is None:
+        return 0
+    matched = 0
+    seen = set()
+    for ts, value in zip(timestamps, values):
+        bucket = ts // forecast_log_step
+        if bucket < lo or bucket > hi or bucket in seen:
+            continue
+        seen.add(bucket)
+        slot = bucket % forecast_log_slots
+        row = con.execute(get_forecast_q, (name, slot, bucket)).fetchone()
+        if row is None:
+            continue
+        horizon, yhat = row
+        error = yhat - value
+        con.execute(delete_forecast_q, (name, slot))
+        con.execute(update_errors_q, {
+            "name": name,
+            "horizon": horizon,
+            "error": error,
+            "abs": abs(error),
+            "sq": error * error,
+            "actual": abs(value),
+            "updated": now,
+            "alpha": error_alpha,
+        })
+        matched += 1
+    return matched
+
+def summarize(rows) -> list[dict]:
+    stats = []
+    for horizon, count, sum_error, sum_abs, sum_sq, sum_actual, ewma_abs, ewma_actual, updated in rows:
+        stats.append({
+            "horizon_seconds": horizon,
+            "count": count,
+            "mae": sum_abs / count,
+            "rmse": math.sqrt(sum_sq / count),
+            "bias": sum_error / count,
+            "nmae": sum_abs / sum_actual if sum_actual else None,
+            "ewma_mae": ewma_abs,
+            "ewma_nmae": ewma_abs / ewma_actual if ewma_actual else None,
+            "updated": datetime.fromtimestamp(updated, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    return stats
+
+def drift(stats: list[dict]) -> float | None:
+    # recent error relative to the actual values, weighted by the number of joined forecasts of the horizons
+    usable = [s for s in stats if s["count"] >= drift_min_count and s["ewma_nmae"] is not None]
+    if not usable:
+        return None
+    return sum(s["ewma_nmae"] * s["count"] for s in usable) / sum(s["count"] for s in usable)
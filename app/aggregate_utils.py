@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from .model_utils import load_model, predict_yhat, get_generation
+from .predict_utils import fast_predict, get_predictor, to_us, UnsupportedModel
+from .metrics_utils import timed, predict_seconds
+
+# An aggregate model is declared by the members column of the models table, its forecast is the sum of the forecasts
+# of its members on the same timestamps. With reconcile_weight > 0 the aggregate also has data and a model of its own
+# and the forecast is weight * own + (1 - weight) * sum, without it the aggregate is derived only: it's neither fed
+# nor trained.
+
+# the definitions are re-read after this many seconds, so that the other workers see new aggregates
+refresh_seconds = float(os.getenv("AGGREGATE_REFRESH_SECONDS", "30"))
+
+aggregates = {} # name -> (members, reconcile_weight)
+loaded_at = float("-inf")
+lock = threading.Lock()
+
+def get_aggregates() -> dict[str, tuple[list[str], float]]:
+    global aggregates, loaded_at
+    if time.monotonic() - loaded_at > refresh_seconds:
+        from .db_utils import list_aggregates
+        with lock:
+            if time.monotonic() - loaded_at > refresh_seconds:
+                aggregates = list_aggregates()
+                loaded_at = time.monotonic()
+    return aggregates
+
+def invalidate_aggregates():
+    global loaded_at
+    loaded_at = float("-inf")
+
+def get_aggregate(name) -> tuple[list[str], float] | None:
+    return get_aggregates().get(name)
+
+def derived_reason(name) -> str | None:
+    # why samples or a training of the model are refused, None for the models that have data of their own
+    aggregate = get_aggregate(name)
+    if aggregate is None or aggregate[1] > 0:
+        return None
+    return f"Model {name} is an aggregate of {', '.join(aggregate[0])}, it has no data of its own"
+
+def validate(name, members: list[str], reconcile_weight: float):
+    # against the stored definitions, they may have been changed by another worker
+    invalidate_aggregates()
+    if not 0 <= reconcile_weight <= 1:
+        raise ValueError("reconcile_weight has to be between 0 and 1")
+    if reconcile_weight > 0 and not members:
+        raise ValueError("reconcile_weight needs members")
+    if name in members:
+        raise ValueError(f"Model {name} can't be a member of itself")
+    nested = [m for m in members if get_aggregate(m) is not None]
+    if nested:
+        raise ValueError(f"Members {', '.join(nested)} are aggregates themselves")
+    parents = [a for a, (m, _) in get_aggregates().items() if name in m]
+    if members and parents:
+        raise ValueError(f"Model {name} is a member of {', '.join(parents)}, it can't be an aggregate")
+
+def generation(name):
+    # changes whenever the aggregate or any of its members is retrained
+    aggregate = get_aggregate(name)
+    if aggregate is None:
+        return get_generation(name)
+    return (get_generation(name), *(get_generation(m) for m in aggregate[0]))
+
+def sum_members(members: list[str], ds) -> np.ndarray:
+    # the timestamps are converted once and the members with the same seasonalities share the Fourier features
+    ts_us = to_us(ds)
+    features = {}
+    total = np.zeros(len(ts_us))
+    for name in members:
+        model = load_model(name)
+        predictor = None
+        if fast_predict:
+            try:
+                predictor = get_predictor(model)
+            except UnsupportedModel:
+                pass
+        if predictor is None:
+            total += predict_yhat(model, ds, fast=False)
+            continue
+        key = predictor.freqs.tobytes()
+        if key not in features:
+            features[key] = predictor.features(ts_us)
+        total += predictor.predict(ts_us, features[key])
+    return total
+
+def forecast_yhat(name, ds) -> np.ndarray:
+    aggregate = get_aggregate(name)
+    if aggregate is None:
+        return predict_yhat(load_model(name), ds)
+    members, weight = aggregate
+    yhat = sum_members(members, ds)
+    if weight > 0:
+        yhat = weight * predict_yhat(load_model(name), ds) + (1 - weight) * yhat
+    return yhat
+
+@timed(predict_seconds, "aggregate")
+def aggregate_forecast(start_date: str, periods: int, name: str) -> pd.DataFrame:
+    # same as model_utils.generate_forecast for an aggregate
+    ds = pd.date_range(start=datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S"), periods=periods, freq="h")
+    return pd.DataFrame({"ds": ds, "yhat": forecast_yhat(name, ds)})
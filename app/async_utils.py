@@ -0,0 +1,37 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# blocking work of the async handlers goes to these pools instead of the shared default threadpool
+db_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DB_EXECUTOR_WORKERS", "4")), thread_name_prefix="db")
+predict_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PREDICT_EXECUTOR_WORKERS", "4")), thread_name_prefix="predict")
+
+async def run_in(executor, fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+class SingleFlight:
+    # concurrent calls with the same key share one execution and its result (or exception),
+    # only used from the event loop, so no locking is needed
+    def __init__(self):
+        self.calls = {}
+        self.executions = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        # fn returns the awaitable to share, e.g. lambda: run_in(executor, ...)
+        future = self.calls.get(key)
+        if future is None:
+            self.executions += 1
+            future = asyncio.ensure_future(fn())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None))
+        else:
+            self.shared += 1
+        # a disconnecting client must not cancel the execution the others are waiting for
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.calls), "executions": self.executions, "shared": self.shared}
+
+single_flight = SingleFlight()
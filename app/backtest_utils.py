@@ -0,0 +1,124 @@
+import os
+import time
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .model_utils import ModelParams, build_model, predict_yhat, parseSeasonality
+from .db_utils import get_model, parseModelParams, load_training_data
+
+backtest_workers = int(os.getenv("BACKTEST_WORKERS", str(os.cpu_count() or 1)))
+backtest_max_candidates = int(os.getenv("BACKTEST_MAX_CANDIDATES", "64"))
+# one backtest at a time, it keeps all the cores busy anyway
+backtest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backtest")
+
+# params that only change the fit, the training window params would change the data the cutoffs are made from
+tunable_params = [
+    "changepoint_prior_scale",
+    "six_hour_fourier_order",
+    "yearly_seasonality",
+    "weekly_seasonality",
+    "daily_seasonality",
+    "seasonality_mode",
+    "custom_seasonality_period",
+    "custom_seasonality_fourier_order",
+]
+seasonality_params = ["yearly_seasonality", "weekly_seasonality", "daily_seasonality"]
+seasonality_modes = ["additive", "multiplicative"]
+
+def candidates(base: ModelParams, grid: dict[str, list]) -> list[dict]:
+    # cartesian product of the grid values, each candidate is a dict of the overridden params
+    unknown = set(grid) - set(tunable_params)
+    if unknown:
+        raise ValueError(f"Unsupported params {', '.join(sorted(unknown))}, use some of {', '.join(tunable_params)}")
+    keys = list(grid)
+    combos = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+    if len(combos) > backtest_max_candidates:
+        raise ValueError(f"{len(combos)} candidates, at most {backtest_max_candidates} are allowed")
+    # all of them are validated before anything is fitted
+    for combo in combos:
+        apply_overrides(base, combo)
+    return combos
+
+def apply_overrides(base: ModelParams, overrides: dict) -> ModelParams:
+    # validated like the stored params, the seasonalities can be given as "True"/"False" like in the params table
+    update = {k: parseSeasonality(v) if k in seasonality_params else v for k, v in overrides.items()}
+    for k in seasonality_params:
+        v = update.get(k)
+        if isinstance(v, str) and v != "auto":
+            raise ValueError(f"Invalid {k} {v}, use True, False, auto or a Fourier order")
+    if update.get("seasonality_mode", base.seasonality_mode) not in seasonality_modes:
+        raise ValueError(f"Invalid seasonality_mode {update['seasonality_mode']}, use one of {', '.join(seasonality_modes)}")
+    params = ModelParams.model_validate({**base.model_dump(), **update})
+    params.has_custom_seasonality = params.custom_seasonality_period > 0 and params.custom_seasonality_fourier_order > 0
+    return params
+
+def cutoffs(df: pd.DataFrame, count: int, horizon: pd.Timedelta) -> list[pd.Timestamp]:
+    # the last cutoff leaves one horizon of data for the evaluation, the others are a horizon apart
+    last = df["ds"].max() - horizon
+    points = [last - i * horizon for i in range(count)]
+    return sorted(c for c in points if (df["ds"] <= c).sum() >= 2)
+
+def evaluate(params: ModelParams, train: pd.DataFrame, test: pd.DataFrame) -> dict:
+    # runs in the worker process
+    import logging
+    logging.getLogger("cmdstanpy").disabled = True
+    model = build_model(params)
+    start = time.perf_counter()
+    model.fit(train)
+    fit_seconds = time.perf_counter() - start
+    yhat = predict_yhat(model, test["ds"])
+    y = test["y"].values
+    errors = np.abs(yhat - y)
+    nonzero = y != 0
+    return {
+        "mae": float(errors.mean()),
+        "mape": float((errors[nonzero] / np.abs(y[nonzero])).mean()) if nonzero.any() else None,
+        "fit_seconds": fit_seconds,
+    }
+
+def run_backtest(model_name, grid: dict[str, list], cutoff_count: int = 3, horizon_hours: float = 24) -> dict:
+    base = parseModelParams(get_model(model_name))
+    combos = candidates(base, grid)
+    df = load_training_data(model_name, base)
+    horizon = pd.Timedelta(hours=horizon_hours)
+    points = cutoffs(df, cutoff_count, horizon)
+    if not points:
+        raise ValueError(f"Not enough data of model {model_name} for a {horizon_hours}h horizon")
+    splits = [(df[df["ds"] <= c], df[(df["ds"] > c) & (df["ds"] <= c + horizon)]) for c in points]
+    start = time.perf_counter()
+    # spawn, for the same reasons as the training pool
+    with ProcessPoolExecutor(max_workers=backtest_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {
+            (i, j): pool.submit(evaluate, apply_overrides(base, combo), train, test)
+            for i, combo in enumerate(combos)
+            for j, (train, test) in enumerate(splits)
+        }
+        results = []
+        for i, combo in enumerate(combos):
+            folds, errors = [], []
+            for j in range(len(splits)):
+                try:
+                    folds.append(futures[(i, j)].result())
+                except Exception as e:
+                    errors.append(str(e))
+            mapes = [f["mape"] for f in folds if f["mape"] is not None]
+            results.append({
+                "params": combo,
+                "mae": float(np.mean([f["mae"] for f in folds])) if folds else None,
+                "mape": float(np.mean(mapes)) if mapes else None,
+                "fit_seconds": round(float(np.mean([f["fit_seconds"] for f in folds])), 3) if folds else None,
+                "folds": len(folds),
+                "errors": errors,
+            })
+    results.sort(key=lambda r: (r["mae"] is None or r["folds"] < len(splits), r["mae"] or 0))
+    best = results[0] if results and results[0]["mae"] is not None else None
+    print(f"✅ Backtest of model {model_name}: {len(combos)} candidates x {len(splits)} cutoffs in {time.perf_counter() - start:.1f}s")
+    return {
+        "cutoffs": [c.strftime("%Y-%m-%d %H:%M:%S") for c in points],
+        "horizon_hours": horizon_hours,
+        "candidates": results,
+        "best": best,
+        "best_params": apply_overrides(base, best["params"]) if best else None,
+    }
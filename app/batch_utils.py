@@ -0,0 +1,94 @@
+import os
+import threading
+import traceback
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from .model_utils import load_model, predict_yhat
+from .metrics_utils import timed, predict_seconds
+from .predict_utils import fast_predict, get_predictor, to_us, UnsupportedModel
+from .aggregate_utils import get_aggregate, forecast_yhat
+
+batch_workers = int(os.getenv("PREDICT_BATCH_WORKERS", "4"))
+batch_max_items = int(os.getenv("PREDICT_BATCH_MAX_ITEMS", "1000"))
+
+executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="predict-batch")
+
+def time_grid(start_date: str, periods: int, freq: str):
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
+    ds = pd.date_range(start=start_dt, periods=periods, freq=freq)
+    return ds, to_us(ds), list(ds.strftime("%Y-%m-%d %H:%M:%S"))
+
+def forecast_model(name, items, grids, features, features_lock, results):
+    # items: [(index, grid key)], all of them for the same model
+    if get_aggregate(name) is not None:
+        for i, key in items:
+            try:
+                ds, _, labels = grids[key]
+                results[i] = {"ds": labels, "yhat": np.round(forecast_yhat(name, ds), 2).tolist()}
+            except FileNotFoundError as e:
+                results[i] = {"error": f"Member model {os.path.basename(e.filename or '')} of {name} doesn't exist"}
+            except Exception as e:
+                results[i] = {"error": str(e)}
+        return
+    try:
+        model = load_model(name)
+    except FileNotFoundError:
+        for i, _ in items:
+            results[i] = {"error": f"Model {name} doesn't exist"}
+        return
+    except Exception as e:
+        print(traceback.format_exc())
+        for i, _ in items:
+            results[i] = {"error": str(e)}
+        return
+    predictor = None
+    if fast_predict:
+        try:
+            predictor = get_predictor(model)
+        except UnsupportedModel:
+            pass
+    for i, key in items:
+        try:
+            ds, ts_us, labels = grids[key]
+            if predictor is not None:
+                # models with the same seasonalities on the same grid share the Fourier features
+                fkey = (key, predictor.freqs.tobytes())
+                with features_lock:
+                    x = features.get(fkey)
+                if x is None:
+                    x = predictor.features(ts_us)
+                    with features_lock:
+                        features[fkey] = x
+                yhat = predictor.predict(ts_us, x)
+            else:
+                yhat = predict_yhat(model, ds, fast=False)
+            results[i] = {"ds": labels, "yhat": np.round(yhat, 2).tolist()}
+        except Exception as e:
+            results[i] = {"error": str(e)}
+
+@timed(predict_seconds, "batch")
+def forecast_batch(requests) -> list[dict]:
+    # requests: items with model, start_date, periods and freq, returns a dict with ds/yhat or error for each of them
+    results = [None] * len(requests)
+    grids = {}
+    by_model = defaultdict(list)
+    for i, r in enumerate(requests):
+        key = (r.start_date, r.periods, r.freq)
+        if key not in grids:
+            try:
+                grids[key] = time_grid(*key)
+            except Exception as e:
+                grids[key] = e
+        if isinstance(grids[key], Exception):
+            results[i] = {"error": str(grids[key])}
+            continue
+        by_model[r.model].append((i, key))
+    features = {}
+    features_lock = threading.Lock()
+    futures = [executor.submit(forecast_model, name, items, grids, features, features_lock, results) for name, items in by_model.items()]
+    for f in futures:
+        f.result()
+    return results
@@ -3,28 +3,118 @@ import logging
 logging.getLogger("prophet.plot").disabled = True
 import sqlite3
 import os
-import sys
-from numpy import random
-from datetime import date,timedelta
-from .model_utils import train_and_save, delete_serialized_model
+import threading
+import time
+import itertools
+import collections
+import traceback
+import urllib.parse
+from datetime import datetime, timezone
+from .model_utils import train_and_save, delete_serialized_model, parseModelParams
+from .grid_utils import drop_grid
+from .aggregate_utils import invalidate_aggregates
+from .sample_utils import generate_samples
+from .metrics_utils import timed, sql_seconds, ingested_samples, forget_model
+from . import accuracy_utils
 
 db_file = os.getenv("DB_FILE", "data/db.sqlite")
+export_chunk_rows = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+# "single" keeps the samples of all the models in the tables of DB_FILE, "partitioned" keeps each model in its own
+# SQLite file in PARTITION_DIR (see PartitionedStorage) and DB_FILE only holds the params of the models
+storage_backend = os.getenv("STORAGE_BACKEND", "single")
+partition_dir = os.getenv("PARTITION_DIR", os.path.join(os.path.dirname(db_file), "partitions"))
+# connections to partition files kept open by each thread
+partition_max_connections = int(os.getenv("PARTITION_MAX_CONNECTIONS", "64"))
+
+# applied to each new connection
+pragmas_q = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    f"PRAGMA busy_timeout={int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))};",
+    f"PRAGMA cache_size=-{int(os.getenv('DB_CACHE_SIZE_KIB', '16384'))};",
+    f"PRAGMA mmap_size={int(os.getenv('DB_MMAP_SIZE', str(128 * 1024 * 1024)))};",
+    "PRAGMA temp_store=MEMORY;",
+]
+local = threading.local()
+
+# raw samples older than this are rolled up into the aggregate tables and deleted, 0 = keep forever
+# (can be overridden per model by raw_retention_hours)
+raw_retention_hours = float(os.getenv("RAW_RETENTION_HOURS", "0"))
+# 5-minute aggregates older than this are deleted (hourly aggregates are kept), 0 = keep forever
+rollup_5m_retention_hours = float(os.getenv("ROLLUP_5M_RETENTION_HOURS", "0"))
+compaction_interval_seconds = int(os.getenv("COMPACTION_INTERVAL_SECONDS", "3600"))
+
+# aggregate tables with the size of their buckets in seconds, from the finest
+rollups = [("metrics_5m", 300), ("metrics_1h", 3600)]
 
 insert_measurement_q = ''' INSERT INTO metrics(name,timestamp,value)
               VALUES(?,?,?) '''
 
-delete_measurements_q = ''' DELETE FROM metrics WHERE name = ? '''
+delete_measurements_q = [
+    ''' DELETE FROM metrics WHERE name = ? ''',
+    ''' DELETE FROM metrics_5m WHERE name = ? ''',
+    ''' DELETE FROM metrics_1h WHERE name = ? ''',
+    ''' DELETE FROM model_state WHERE name = ? ''',
+] + accuracy_utils.reset_accuracy_q
+
+# samples written since the last fit, counted in the same transaction as the samples, so that all the workers see them
+count_ingested_q = ''' INSERT INTO model_state(name, ingested) VALUES(?,?)
+            ON CONFLICT(name) DO UPDATE SET ingested = ingested + excluded.ingested '''
+
+# the samples written while the model was being fitted are still counted
+reset_ingested_q = ''' UPDATE model_state SET ingested = MAX(ingested - ?, 0) WHERE name = ? '''
+
+get_ingested_q = ''' SELECT ingested FROM model_state WHERE name = ? '''
+
+list_ingested_q = ''' SELECT name, ingested FROM model_state '''
+
+# models whose raw data was already rolled up are still in metrics_1h
+series_names_q = ''' SELECT name FROM metrics UNION SELECT name FROM metrics_1h '''
+
+# merges the raw samples older than the cutoff into the buckets of an aggregate table
+rollup_q = ''' INSERT INTO {table}(name, timestamp, mean, max, count)
+                SELECT name, (timestamp / {step}) * {step}, AVG(value), MAX(value), COUNT(*)
+                FROM metrics WHERE name = ? AND timestamp < ? GROUP BY 1, 2
+            ON CONFLICT(name, timestamp) DO
+            UPDATE SET
+                mean=(mean * count + excluded.mean * excluded.count) / (count + excluded.count),
+                max=MAX(max, excluded.max),
+                count=count + excluded.count '''
 
-list_models_q = ''' SELECT DISTINCT name FROM metrics '''
+delete_raw_before_q = ''' DELETE FROM metrics WHERE name = ? AND timestamp < ? '''
+
+delete_5m_before_q = ''' DELETE FROM metrics_5m WHERE timestamp < ? '''
+
+# the oldest data of a model in any of the tables, the (name, timestamp) keys make it an index lookup
+first_timestamp_q = ''' SELECT MIN(t) FROM (
+                    SELECT MIN(timestamp) AS t FROM metrics WHERE name = ?
+                    UNION ALL SELECT MIN(timestamp) FROM metrics_5m WHERE name = ?
+                    UNION ALL SELECT MIN(timestamp) FROM metrics_1h WHERE name = ?) '''
+
+retention_overrides_q = ''' SELECT name, raw_retention_hours FROM models WHERE raw_retention_hours > 0 '''
 get_model_q = ''' SELECT 
                     yearly_seasonality,
                     weekly_seasonality,
                     daily_seasonality,
                     custom_seasonality_period,
                     custom_seasonality_fourier_order,
-                    seasonality_mode 
+                    seasonality_mode,
+                    train_max_age_hours,
+                    train_max_rows,
+                    train_resolution_seconds,
+                    warm_start,
+                    raw_retention_hours,
+                    changepoint_prior_scale,
+                    six_hour_fourier_order,
+                    members,
+                    reconcile_weight
                 FROM models WHERE name = ? '''
 
+list_aggregates_q = ''' SELECT name, members, reconcile_weight FROM models WHERE members != '' '''
+
+# a deleted model is no longer an aggregate, its other params are kept as before
+clear_aggregate_q = ''' UPDATE models SET members = '', reconcile_weight = 0 WHERE name = ? '''
+
 upsert_model_q = '''INSERT INTO models(
                                     name,
                                     yearly_seasonality,
@@ -32,8 +122,17 @@ upsert_model_q = '''INSERT INTO models(
                                     daily_seasonality,
                                     custom_seasonality_period,
                                     custom_seasonality_fourier_order,
-                                    seasonality_mode
-                                ) VALUES(?,?,?,?,?,?,?)
+                                    seasonality_mode,
+                                    train_max_age_hours,
+                                    train_max_rows,
+                                    train_resolution_seconds,
+                                    warm_start,
+                                    raw_retention_hours,
+                                    changepoint_prior_scale,
+                                    six_hour_fourier_order,
+                                    members,
+                                    reconcile_weight
+                                ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
                     ON CONFLICT(name) DO
                     UPDATE SET
                         yearly_seasonality=excluded.yearly_seasonality,
@@ -41,22 +140,88 @@ upsert_model_q = '''INSERT INTO models(
                         daily_seasonality=excluded.daily_seasonality,
                         custom_seasonality_period=excluded.custom_seasonality_period,
                         custom_seasonality_fourier_order=excluded.custom_seasonality_fourier_order,
-                        seasonality_mode=excluded.seasonality_mode
+                        seasonality_mode=excluded.seasonality_mode,
+                        train_max_age_hours=excluded.train_max_age_hours,
+                        train_max_rows=excluded.train_max_rows,
+                        train_resolution_seconds=excluded.train_resolution_seconds,
+                        warm_start=excluded.warm_start,
+                        raw_retention_hours=excluded.raw_retention_hours,
+                        changepoint_prior_scale=excluded.changepoint_prior_scale,
+                        six_hour_fourier_order=excluded.six_hour_fourier_order,
+                        members=excluded.members,
+                        reconcile_weight=excluded.reconcile_weight
                     WHERE name = excluded.name'''
 
-# select_measurements = ''' SELECT * FROM metrics WHERE name = (?) '''
-
 drop_tables_q = [ 
+    """DROP INDEX IF EXISTS metrics_name_timestamp;""",
     """DROP TABLE IF EXISTS metrics;""",
+    """DROP TABLE IF EXISTS metrics_5m;""",
+    """DROP TABLE IF EXISTS metrics_1h;""",
     """DROP TABLE IF EXISTS models;""",
+    """DROP TABLE IF EXISTS model_state;""",
+    """DROP TABLE IF EXISTS forecasts;""",
+    """DROP TABLE IF EXISTS forecast_errors;""",
 ]
 
-create_tables_q = [ 
+# bump together with adding a new entry to migrations_q
+schema_version = 7
+
+# the samples and the bookkeeping of the models, these are in each partition file with STORAGE_BACKEND=partitioned
+series_tables_q = [
+    # timestamp is in seconds since epoch (UTC)
     """CREATE TABLE IF NOT EXISTS metrics (
-            timestamp DATE NOT NULL,
+            timestamp INTEGER NOT NULL,
             name TEXT NOT NULL,
             value REAL NOT NULL
         );""",
+    """CREATE INDEX IF NOT EXISTS metrics_name_timestamp ON metrics(name, timestamp);""",
+    # aggregates of the raw samples that are past their retention, timestamp is the start of the bucket
+    """CREATE TABLE IF NOT EXISTS metrics_5m (
+            name TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            max REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (name, timestamp)
+        ) WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS metrics_1h (
+            name TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            max REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (name, timestamp)
+        ) WITHOUT ROWID;""",
+    # bookkeeping of the retrain scheduler
+    """CREATE TABLE IF NOT EXISTS model_state (
+            name TEXT PRIMARY KEY,
+            ingested INT NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;""",
+    # served forecasts waiting for their actual values (see accuracy_utils), bucket is target // FORECAST_LOG_STEP_SECONDS
+    """CREATE TABLE IF NOT EXISTS forecasts (
+            name TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            horizon INTEGER NOT NULL,
+            yhat REAL NOT NULL,
+            PRIMARY KEY (name, slot)
+        ) WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS forecast_errors (
+            name TEXT NOT NULL,
+            horizon INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum_error REAL NOT NULL,
+            sum_abs REAL NOT NULL,
+            sum_sq REAL NOT NULL,
+            sum_actual REAL NOT NULL,
+            ewma_abs REAL NOT NULL,
+            ewma_actual REAL NOT NULL,
+            updated INTEGER NOT NULL,
+            PRIMARY KEY (name, horizon)
+        ) WITHOUT ROWID;""",
+]
+
+create_tables_q = series_tables_q + [
     # https://github.com/facebook/prophet/blob/v1.1.7/python/prophet/forecaster.py#L33-L83
     """CREATE TABLE IF NOT EXISTS models (
             name TEXT PRIMARY KEY,
@@ -65,82 +230,498 @@ create_tables_q = [
             daily_seasonality TEXT NOT NULL DEFAULT 'auto',
             custom_seasonality_period REAL NOT NULL,
             custom_seasonality_fourier_order INT NOT NULL,
-            seasonality_mode TEXT NOT NULL DEFAULT 'additive'
-        );"""
+            seasonality_mode TEXT NOT NULL DEFAULT 'additive',
+            train_max_age_hours REAL NOT NULL DEFAULT 0,
+            train_max_rows INT NOT NULL DEFAULT 0,
+            train_resolution_seconds INT NOT NULL DEFAULT 0,
+            warm_start TEXT NOT NULL DEFAULT 'False',
+            raw_retention_hours REAL NOT NULL DEFAULT 0,
+            changepoint_prior_scale REAL NOT NULL DEFAULT 0.01,
+            six_hour_fourier_order INT NOT NULL DEFAULT 10,
+            members TEXT NOT NULL DEFAULT '',
+            reconcile_weight REAL NOT NULL DEFAULT 0
+        );""",
+]
+
+series_table_names = ["metrics", "metrics_5m", "metrics_1h", "model_state", "forecasts", "forecast_errors"]
+
+# every model with anything in the series tables, for moving them into partitions
+all_series_names_q = " UNION ".join(f"SELECT name FROM {table}" for table in series_table_names)
+
+has_series_q = f"SELECT 1 FROM ({all_series_names_q}) WHERE name = ? LIMIT 1"
+
+# a new partition file gets the series tables, auto vacuum has to be set before the first table is created
+partition_setup_q = ["PRAGMA auto_vacuum=INCREMENTAL;"] + series_tables_q + [f"PRAGMA user_version={schema_version};"]
+
+# migrations_q[i] upgrades an existing database from schema version i to i+1
+migrations_q = [
+    # v1: text timestamps -> seconds since epoch
+    [
+        """ALTER TABLE metrics RENAME TO metrics_v0;""",
+        """CREATE TABLE metrics (
+                timestamp INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                value REAL NOT NULL
+            );""",
+        """INSERT INTO metrics(timestamp, name, value)
+                SELECT CAST(strftime('%s', timestamp) AS INTEGER), name, value FROM metrics_v0
+                WHERE strftime('%s', timestamp) IS NOT NULL
+                ORDER BY name, timestamp;""",
+        """DROP TABLE metrics_v0;""",
+    ],
+    # v2: training window and warm start settings
+    [
+        """ALTER TABLE models ADD COLUMN train_max_age_hours REAL NOT NULL DEFAULT 0;""",
+        """ALTER TABLE models ADD COLUMN train_max_rows INT NOT NULL DEFAULT 0;""",
+        """ALTER TABLE models ADD COLUMN train_resolution_seconds INT NOT NULL DEFAULT 0;""",
+        """ALTER TABLE models ADD COLUMN warm_start TEXT NOT NULL DEFAULT 'False';""",
+    ],
+    # v3: per-model retention of the raw samples (aggregate tables are created by create_tables_q)
+    [
+        """ALTER TABLE models ADD COLUMN raw_retention_hours REAL NOT NULL DEFAULT 0;""",
+    ],
+    # v4: tunable trend flexibility and six-hour seasonality (they used to be hard-coded)
+    [
+        """ALTER TABLE models ADD COLUMN changepoint_prior_scale REAL NOT NULL DEFAULT 0.01;""",
+        """ALTER TABLE models ADD COLUMN six_hour_fourier_order INT NOT NULL DEFAULT 10;""",
+    ],
+    # v5: samples ingested since the last fit (model_state is created by create_tables_q)
+    [],
+    # v6: served forecasts and their errors (the tables are created by create_tables_q)
+    [],
+    # v7: aggregate models, members is a comma separated list of model names
+    [
+        """ALTER TABLE models ADD COLUMN members TEXT NOT NULL DEFAULT '';""",
+        """ALTER TABLE models ADD COLUMN reconcile_weight REAL NOT NULL DEFAULT 0;""",
+    ],
 ]
 
+def get_connection(path=None, setup=()):
+    # one connection per thread and db file that is reused across the calls, setup runs when it's opened.
+    # a partition file that was deleted (and maybe created again) since is reopened, the least recently used
+    # partitions are closed
+    path = path or db_file
+    connections = getattr(local, "connections", None)
+    if connections is None:
+        connections = local.connections = collections.OrderedDict()
+    entry = connections.get(path)
+    if entry is not None and path != db_file and entry[1] != file_id(path):
+        entry[0].close()
+        entry = None
+    if entry is None:
+        con = open_connection(path=path, setup=setup)
+        entry = connections[path] = (con, file_id(path))
+        partitions = [p for p in connections if p != db_file]
+        for p in partitions[:max(len(partitions) - partition_max_connections, 0)]:
+            connections.pop(p)[0].close()
+    connections.move_to_end(path)
+    return entry[0]
+
+def open_connection(check_same_thread=True, path=None, setup=()):
+    con = sqlite3.connect(path or db_file, check_same_thread=check_same_thread)
+    for statement in pragmas_q:
+        con.execute(statement)
+    for statement in setup:
+        con.execute(statement)
+    con.commit()
+    return con
+
+def file_id(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+class SingleFileStorage:
+    # all the models in the tables of DB_FILE
+    def path(self, name) -> str:
+        return db_file
+
+    def connection(self, name, create=True):
+        return get_connection()
+
+    def open(self, name):
+        # a connection of its own, e.g. for reading from another thread
+        return open_connection(check_same_thread=False)
+
+    def names(self) -> list[str]:
+        with get_connection() as con:
+            return [row[0] for row in con.execute(series_names_q)]
+
+    def connections(self) -> list:
+        return [get_connection()]
+
+    def drop(self, name):
+        with get_connection() as con:
+            for statement in delete_measurements_q:
+                con.execute(statement, (name,))
+
+    def drop_all(self):
+        # the tables are recreated by reset_database
+        pass
+
+class PartitionedStorage:
+    # one SQLite file per model: writes to different models don't wait for each other's lock, deleting a model
+    # is an unlink and the reads of a model only touch its file
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name) -> str:
+        # any model name is a safe file name once quoted
+        return os.path.join(self.directory, urllib.parse.quote(name, safe="") + ".sqlite")
+
+    def connection(self, name, create=True):
+        path = self.path(name)
+        if not create and not os.path.exists(path):
+            # reading a model without data doesn't create its file
+            return get_connection(":memory:", setup=series_tables_q)
+        os.makedirs(self.directory, exist_ok=True)
+        return get_connection(path, setup=partition_setup_q)
+
+    def open(self, name):
+        path = self.path(name)
+        if not os.path.exists(path):
+            return open_connection(check_same_thread=False, path=":memory:", setup=series_tables_q)
+        return open_connection(check_same_thread=False, path=path, setup=partition_setup_q)
+
+    def names(self) -> list[str]:
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [urllib.parse.unquote(f.removesuffix(".sqlite")) for f in files if f.endswith(".sqlite")]
+
+    def connections(self):
+        # opened one at a time, the older ones may be closed to stay within PARTITION_MAX_CONNECTIONS
+        for name in self.names():
+            yield self.connection(name)
+
+    def drop(self, name):
+        path = self.path(name)
+        for p in (path, path + "-wal", path + "-shm"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def drop_all(self):
+        for name in self.names():
+            self.drop(name)
+
+storage_backends = {
+    "single": lambda: SingleFileStorage(),
+    "partitioned": lambda: PartitionedStorage(partition_dir),
+}
+if storage_backend not in storage_backends:
+    raise ValueError(f"Unsupported STORAGE_BACKEND {storage_backend}, use one of {', '.join(storage_backends)}")
+storage = storage_backends[storage_backend]()
+
+def migrate_to_partitions(con):
+    # moves the models of the single-table layout into their partition files, one model (and transaction) at a time
+    names = [row[0] for row in con.execute(all_series_names_q)]
+    if not names:
+        return
+    print(f"Moving {len(names)} models from {db_file} to {partition_dir}..")
+    con.commit()
+    for name in names:
+        storage.connection(name)
+        con.execute("ATTACH DATABASE ? AS part;", (storage.path(name),))
+        try:
+            with con:
+                # both files are locked before the model is read, so that the workers starting at the same time move it once
+                con.execute("BEGIN IMMEDIATE;")
+                if con.execute(has_series_q, (name,)).fetchone() is None:
+                    continue
+                # the commit isn't atomic across the two WAL files, a crash may have left a copy in the partition
+                # which is replaced, so that moving the model again doesn't duplicate the samples
+                for table in series_table_names:
+                    con.execute(f"DELETE FROM part.{table} WHERE name = ?;", (name,))
+                    con.execute(f"INSERT INTO part.{table} SELECT * FROM main.{table} WHERE name = ?;", (name,))
+                    con.execute(f"DELETE FROM main.{table} WHERE name = ?;", (name,))
+        finally:
+            con.execute("DETACH DATABASE part;")
+    print(f"✅ Models were moved, {vacuum(con)} pages of {db_file} were freed")
+
+def to_epoch(time) -> int:
+    # naive timestamps are considered to be in UTC
+    if not isinstance(time, datetime):
+        time = datetime.fromisoformat(str(time).strip())
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return int(time.timestamp())
+
+def series_query(model_name, resolution: int = 0) -> tuple[str, list]:
+    # (timestamp, value) rows of a model, raw samples where we still have them and the aggregates before that,
+    # the 5-minute aggregates are skipped if the requested resolution is coarser than an hour
+    q = "SELECT timestamp, value FROM metrics WHERE name = ?"
+    args = [model_name]
+    finer = ["metrics"]
+    for table, step in rollups:
+        if step < 3600 and resolution >= 3600:
+            continue
+        before = " AND ".join(f"timestamp < (SELECT COALESCE(MIN(timestamp), 1 << 62) FROM {t} WHERE name = ?)" for t in finer)
+        q += f" UNION ALL SELECT timestamp, mean FROM {table} WHERE name = ? AND {before}"
+        args += [model_name] * (len(finer) + 1)
+        finer.append(table)
+    return q, args
+
+def first_timestamp(model_name) -> int | None:
+    with storage.connection(model_name, create=False) as con:
+        return con.execute(first_timestamp_q, (model_name,) * 3).fetchone()[0]
+
+@timed(sql_seconds, "load_series")
+def load_series(model_name, since: int | None = None, resolution: int = 0) -> pd.DataFrame:
+    # ds/y dataframe of a model, optionally averaged into buckets of resolution seconds
+    q, args = series_query(model_name, resolution)
+    q = f"SELECT timestamp, value FROM ({q})"
+    if since is not None:
+        q += " WHERE timestamp >= ?"
+        args.append(since)
+    if resolution > 1:
+        q = f"SELECT (timestamp / {int(resolution)}) * {int(resolution)} AS timestamp, AVG(value) AS value FROM ({q}) GROUP BY 1"
+    df = pd.read_sql_query(q + " ORDER BY timestamp", storage.connection(model_name, create=False), params=args)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+    return df.rename(columns={"timestamp": "ds", "value": "y"})
+
+def export_chunks(model_name, since: int | None = None, until: int | None = None, chunk_rows: int = export_chunk_rows):
+    # lists of (timestamp, value) rows ordered by time, at most chunk_rows at once, so memory stays constant.
+    # the query runs on its own connection (closed with the generator) as the chunks may be fetched from different threads
+    q, args = series_query(model_name)
+    q = f"SELECT timestamp, value FROM ({q}) WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp"
+    args += [since if since is not None else -(1 << 62), until if until is not None else 1 << 62]
+    con = storage.open(model_name)
+    try:
+        cur = con.execute(q, args)
+    except Exception:
+        con.close()
+        raise
+    def chunks():
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            con.close()
+    return chunks()
+
+def training_query(model_name, params) -> tuple[str, list]:
+    # newest train_max_rows rows not older than train_max_age_hours (relative to the newest row),
+    # averaged into train_resolution_seconds buckets
+    series, series_args = series_query(model_name, params.train_resolution_seconds)
+    q = f"SELECT timestamp, value FROM ({series})"
+    args = list(series_args)
+    if params.train_max_age_hours > 0:
+        q += f" WHERE timestamp >= (SELECT MAX(timestamp) FROM ({series})) - ?"
+        args += series_args + [int(params.train_max_age_hours * 3600)]
+    if params.train_max_rows > 0:
+        q += " ORDER BY timestamp DESC LIMIT ?"
+        args.append(params.train_max_rows)
+    if params.train_resolution_seconds > 1:
+        res = int(params.train_resolution_seconds)
+        q = f"SELECT (timestamp / {res}) * {res} AS timestamp, AVG(value) AS value FROM ({q}) GROUP BY 1 ORDER BY 1"
+    else:
+        q = f"SELECT timestamp, value FROM ({q}) ORDER BY timestamp"
+    return q, args
+
+@timed(sql_seconds, "load_training_data")
+def load_training_data(model_name, params) -> pd.DataFrame:
+    q, args = training_query(model_name, params)
+    df = pd.read_sql_query(q, storage.connection(model_name, create=False), params=args)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+    return df.rename(columns={"timestamp": "ds", "value": "y"})
+
 def retrain_and_save(model_name):
-    with sqlite3.connect(db_file) as con:
-        df = pd.read_sql_query(f"SELECT * FROM metrics WHERE name = '{model_name}' ", con)
-        df = df.rename(columns={"timestamp": "ds", "value": "y"})
-        params = get_model(model_name)
-        train_and_save(model_name, params, df)
+    ingested = get_ingested(model_name)
+    params = parseModelParams(get_model(model_name))
+    if params.members and params.reconcile_weight == 0:
+        raise ValueError(f"Model {model_name} is an aggregate of {', '.join(params.members)}, it's not trained")
+    df = load_training_data(model_name, params)
+    result = train_and_save(model_name, params, df)
+    with storage.connection(model_name) as con:
+        con.execute(reset_ingested_q, (ingested, model_name))
+        for statement in accuracy_utils.reset_accuracy_q:
+            con.execute(statement, (model_name,))
+    return result
+
+def get_ingested(model_name) -> int:
+    with storage.connection(model_name, create=False) as con:
+        row = con.execute(get_ingested_q, (model_name,)).fetchone()
+    return row[0] if row else 0
+
+def list_ingested() -> dict[str, int]:
+    ingested = {}
+    for con in storage.connections():
+        with con:
+            ingested.update(con.execute(list_ingested_q).fetchall())
+    return ingested
+
+def now_epoch() -> int:
+    # the same clock as the cutoffs of the compaction, the timestamps of the samples and forecasts are UTC
+    return int(time.time())
+
+@timed(sql_seconds, "record_forecasts")
+def record_forecasts(model_name, targets, yhats) -> int:
+    with storage.connection(model_name) as con:
+        return accuracy_utils.record(con, model_name, [to_epoch(t) for t in targets], yhats, now_epoch())
+
+@timed(sql_seconds, "forecast_errors")
+def forecast_errors(model_name) -> dict:
+    with storage.connection(model_name, create=False) as con:
+        stats = accuracy_utils.summarize(con.execute(accuracy_utils.get_errors_q, (model_name,)).fetchall())
+    return {"model": model_name, "drift": accuracy_utils.drift(stats), "horizons": stats}
+
+def forecast_drift(model_name) -> float | None:
+    return forecast_errors(model_name)["drift"]
+
+def compact_model(con, name, retention_hours) -> int:
+    # rolls up the raw samples past the retention, the cutoff is aligned to hours so that
+    # the buckets of all the aggregate tables end before the first raw sample
+    cutoff = (int(time.time()) - int(retention_hours * 3600)) // 3600 * 3600
+    for table, step in rollups:
+        con.execute(rollup_q.format(table=table, step=step), (name, cutoff))
+    return con.execute(delete_raw_before_q, (name, cutoff)).rowcount
+
+@timed(sql_seconds, "compact_database")
+def compact_database() -> dict:
+    start = time.perf_counter()
+    with get_connection() as con:
+        overrides = dict(con.execute(retention_overrides_q).fetchall())
+    rolled_up = 0
+    for name in storage.names():
+        retention_hours = overrides.get(name) or raw_retention_hours
+        if retention_hours > 0:
+            con = storage.connection(name)
+            with con:
+                rolled_up += compact_model(con, name, retention_hours)
+    freed = 0
+    for con in storage.connections():
+        if rollup_5m_retention_hours > 0:
+            with con:
+                con.execute(delete_5m_before_q, (int(time.time()) - int(rollup_5m_retention_hours * 3600),))
+        freed += vacuum(con)
+    stats = {"rolled_up_rows": rolled_up, "freed_pages": freed, "duration": round(time.perf_counter() - start, 3)}
+    print(f"✅ Database compacted: {stats}")
+    return stats
+
+def vacuum(con) -> int:
+    # switching an existing database to incremental auto vacuum needs one full VACUUM
+    con.commit()
+    before = con.execute("PRAGMA freelist_count;").fetchone()[0]
+    if con.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        con.execute("VACUUM;")
+    else:
+        con.execute("PRAGMA incremental_vacuum;").fetchall()
+    return before - con.execute("PRAGMA freelist_count;").fetchone()[0]
+
+def start_compaction():
+    if compaction_interval_seconds <= 0:
+        return
+    def loop():
+        while True:
+            time.sleep(compaction_interval_seconds)
+            try:
+                compact_database()
+            except Exception:
+                print(traceback.format_exc())
+    threading.Thread(target=loop, name="db-compaction", daemon=True).start()
 
 def reset_database():
-    with sqlite3.connect(db_file) as con:
+    storage.drop_all()
+    with get_connection() as con:
         cur = con.cursor()
         for statement in drop_tables_q + create_tables_q:
             cur.execute(statement)
+        cur.execute(f"PRAGMA user_version={schema_version};")
         print("\n✅ Tables recreated successfully.")
 
 def init_database():
-    with sqlite3.connect(db_file) as con:
+    with get_connection() as con:
         cur = con.cursor()
+        version = cur.execute("PRAGMA user_version;").fetchone()[0]
+        exists = cur.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'metrics';").fetchone()[0] > 0
+        if not exists:
+            # only has an effect before the first table is created
+            cur.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        # each step is committed together with its version (DDL is transactional in SQLite, but the sqlite3 module
+        # doesn't open a transaction for it), so that an interrupted migration starts over from the same step
+        if exists:
+            for i in range(version, schema_version):
+                print(f"Migrating {db_file} to schema version {i + 1}..")
+                cur.execute("BEGIN IMMEDIATE;")
+                for statement in migrations_q[i]:
+                    cur.execute(statement)
+                cur.execute(f"PRAGMA user_version={i + 1};")
+                con.commit()
+        cur.execute("BEGIN IMMEDIATE;")
         for statement in create_tables_q:
             cur.execute(statement)
+        cur.execute(f"PRAGMA user_version={schema_version};")
+        con.commit()
+        if storage_backend == "partitioned":
+            migrate_to_partitions(con)
         print("\n✅ Tables initialized successfully.")
 
 def feed_db(model, days, days_trend_factor, off_hours_factor, jitter):
-    with sqlite3.connect(db_file) as con:
+    with get_connection() as con:
         cur = con.cursor()
 
         # execute statements (DDL)
         for statement in create_tables_q:
             cur.execute(statement)
         print("\n✅ Tables created successfully.")
-        
-        value_fun = lambda hour, min: ((hour%16)*60) + min
-        prepare_samples(
-            cur=cur,
-            days=14,
-            days_trend_factor=days_trend_factor,
-            off_hours_factor=off_hours_factor,
-            value_fun=value_fun,
-            jitter=jitter,
-            model=model,
-        )
-        # commit the changes
-        con.commit()
-
 
-def make_jitter(val, jitter):
-    return random.uniform(val*(1-jitter),val*(1+jitter))
-
-def prepare_samples(cur, days, days_trend_factor, off_hours_factor, value_fun, jitter, model):
-    counter=0
-    nDaysAgo = date.today() - timedelta(days)
-    for day in range(1, days):
-        for hour in range(0, 24):
-            for min in range(0, 60, 5):
-                off_hours = hour < 8
-                value = day * days_trend_factor + make_jitter(value_fun(hour, min), jitter)
-                value = value * (off_hours_factor if off_hours else 1)
-                datum = nDaysAgo + timedelta(day)
-                ts = f'{datum.year}-{datum.month:02}-{datum.day:02} {hour:02}:{min:02}:00.000'
-                # print(f'day: {day}: {ts}')
-                insert_sample(cur, model, ts , value)
-                counter+=1
-                sys.stdout.write("\r%d" % counter)
-                sys.stdout.flush()
-    print(" records were inserted into db.")
+    ts, values = generate_samples(
+        days=days,
+        days_trend_factor=days_trend_factor,
+        off_hours_factor=off_hours_factor,
+        jitter=jitter,
+    )
+    insert_samples(model, ts, values)
+    print(f"{len(ts)} records were inserted into db.")
 
+@timed(sql_seconds, "insert_measurement")
 def insert_measurement(name, time, value):
-    with sqlite3.connect(db_file) as con:
+    with storage.connection(name) as con:
         cur = con.cursor()
         insert_sample(cur, name, time, value)
+        cur.execute(count_ingested_q, (name, 1))
+        accuracy_utils.join_actuals(con, name, [to_epoch(time)], [value], now_epoch())
+    ingested_samples.labels(name).inc()
+
+@timed(sql_seconds, "insert_measurements")
+def insert_measurements(rows):
+    # rows are (name, time, value) tuples, written in one transaction per database file
+    by_name = collections.defaultdict(lambda: ([], []))
+    for name, time, value in rows:
+        by_name[name][0].append(to_epoch(time))
+        by_name[name][1].append(value)
+    by_path = collections.defaultdict(list)
+    for name in by_name:
+        by_path[storage.path(name)].append(name)
+    now = now_epoch()
+    for names in by_path.values():
+        with storage.connection(names[0]) as con:
+            con.executemany(insert_measurement_q, ((name, ts, value) for name in names for ts, value in zip(*by_name[name])))
+            con.executemany(count_ingested_q, ((name, len(by_name[name][0])) for name in names))
+            for name in names:
+                accuracy_utils.join_actuals(con, name, *by_name[name], now)
+    for name, (timestamps, _) in by_name.items():
+        ingested_samples.labels(name).inc(len(timestamps))
+
+@timed(sql_seconds, "insert_samples")
+def insert_samples(name, timestamps, values):
+    # epoch seconds and values of one model, written in one transaction
+    with storage.connection(name) as con:
+        con.executemany(insert_measurement_q, zip(itertools.repeat(name), timestamps.tolist(), values.tolist()))
+        con.execute(count_ingested_q, (name, len(timestamps)))
+        accuracy_utils.join_actuals(con, name, timestamps.tolist(), values.tolist(), now_epoch())
+    ingested_samples.labels(name).inc(len(timestamps))
 
 def upsert_mod(m):
-    with sqlite3.connect(db_file) as con:
+    with get_connection() as con:
         cur = con.cursor()
         m_data = (
             m.name,
@@ -150,33 +731,54 @@ def upsert_mod(m):
             m.custom_seasonality_period,
             m.custom_seasonality_fourier_order,
             m.seasonality_mode,
+            m.train_max_age_hours,
+            m.train_max_rows,
+            m.train_resolution_seconds,
+            m.warm_start,
+            m.raw_retention_hours,
+            m.changepoint_prior_scale,
+            m.six_hour_fourier_order,
+            ",".join(m.members or []),
+            m.reconcile_weight or 0,
         )
         print("Model update")
         print(m_data)
         cur.execute(upsert_model_q, m_data)
         con.commit()
+    invalidate_aggregates()
+
+@timed(sql_seconds, "list_aggregates")
+def list_aggregates() -> dict[str, tuple[list[str], float]]:
+    with get_connection() as con:
+        rows = con.execute(list_aggregates_q).fetchall()
+    return {name: (members.split(","), weight) for name, members, weight in rows}
 
+@timed(sql_seconds, "get_model")
 def get_model(name):
-    with sqlite3.connect(db_file) as con:
+    with get_connection() as con:
         cur = con.cursor()
         cur.execute(get_model_q, (name,))
         rows = cur.fetchone()
         return rows
 
+@timed(sql_seconds, "list_models")
 def list_models_db():
-    with sqlite3.connect(db_file) as con:
-        cur = con.cursor()
-        cur.execute(list_models_q)
-        rows = cur.fetchall()
-        return map(lambda row : row[0], rows)
+    # aggregates may have no data at all
+    return sorted(set(storage.names()) | set(list_aggregates()))
 
 def delete(name):
-    with sqlite3.connect(db_file) as con:
-        cur = con.cursor()
-        cur.execute(delete_measurements_q, (name,))
-        con.commit()
+    storage.drop(name)
+    with get_connection() as con:
+        con.execute(clear_aggregate_q, (name,))
     delete_serialized_model(name)
+    forget_model(name)
+    drop_grid(name)
+    invalidate_aggregates()
 
 def insert_sample(cur, name, time, value):
-    cur.execute(insert_measurement_q, (name, time, value))
+    cur.execute(insert_measurement_q, (name, to_epoch(time), value))
+
 
+if __name__ == "__main__":
+    # creates or migrates the schema of DB_FILE, e.g.: DB_FILE=data/db.sqlite python -m app.db_utils
+    init_database()
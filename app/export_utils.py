@@ -0,0 +1,23 @@
+import numpy as np
+
+# the output can be posted back to /models/{model}/metrics/batch as is
+export_formats = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def format_dates(timestamps) -> list[str]:
+    # epoch seconds to "YYYY-mm-dd HH:MM:SS" (UTC), for a whole chunk at once
+    return [d.replace("T", " ") for d in np.array(timestamps, dtype="datetime64[s]").astype(str)]
+
+def format_chunk(rows, fmt: str) -> bytes:
+    timestamps, values = zip(*rows)
+    dates = format_dates(timestamps)
+    if fmt == "csv":
+        lines = [f"{d},{v!r}\n" for d, v in zip(dates, values)]
+    else:
+        lines = [f'{{"date": "{d}", "value": {v!r}}}\n' for d, v in zip(dates, values)]
+    return "".join(lines).encode("utf-8")
+
+def stream_export(chunks, fmt: str):
+    if fmt == "csv":
+        yield b"date,value\n"
+    for rows in chunks:
+        yield format_chunk(rows, fmt)
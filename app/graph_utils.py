@@ -0,0 +1,62 @@
+import os
+import asyncio
+import hashlib
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from .cache_utils import LRUCache
+from .model_utils import model_file
+from .metrics_utils import timed, render_seconds
+
+# rendered PNGs, the version file of the model and its mtime are part of the key so retrained models never hit old images.
+# both are the same in all the workers, so are the ETags
+graph_cache = LRUCache(
+    max_entries=int(os.getenv("GRAPH_CACHE_MAX_ENTRIES", "128")),
+    max_bytes=int(os.getenv("GRAPH_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+)
+# graphs are rendered here and not on the request threads, so that they can't starve the other endpoints
+render_workers = int(os.getenv("GRAPH_RENDER_WORKERS", "2"))
+executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="graph-render")
+# about this many points of history are plotted, longer spans are read from the rollups
+history_points = int(os.getenv("GRAPH_HISTORY_POINTS", "2000"))
+
+def bucket_start(hours_ago: float, freq: str) -> str:
+    # start of the freq bucket the time falls in, so that the same graph is served until the bucket changes
+    ts = pd.Timestamp(datetime.today()) - pd.Timedelta(hours=hours_ago)
+    return ts.floor(freq).strftime('%Y-%m-%d %H:%M:%S')
+
+def history_resolution(span_seconds: float) -> int:
+    # raw samples (minute samples assumed) for short spans, the 5-minute or hourly rollups (see db_utils.series_query) for longer ones
+    if span_seconds <= history_points * 60:
+        return 0
+    if span_seconds <= history_points * 300:
+        return 300
+    return 3600
+
+def graph_key(kind: str, name: str, **params) -> tuple:
+    path = model_file(name)
+    st = os.stat(path)
+    return (kind, name, os.path.basename(path), st.st_mtime_ns, *sorted(params.items()))
+
+def etag(key: tuple) -> str:
+    return '"' + hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + '"'
+
+def etag_matches(if_none_match: str | None, tag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or tag in tags
+
+def render(key: tuple, draw) -> bytes:
+    png = graph_cache.get(key)
+    if png is None:
+        with timed(render_seconds, key[0]):
+            png = draw().getvalue()
+        graph_cache.put(key, png, size=len(png))
+    return png
+
+async def render_async(key: tuple, draw) -> bytes:
+    return await asyncio.wrap_future(executor.submit(render, key, draw))
+
+def graph_cache_stats() -> dict:
+    return {**graph_cache.stats(), "render_workers": render_workers}
@@ -0,0 +1,87 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+from .aggregate_utils import forecast_yhat, generation
+
+grid_step = pd.Timedelta(os.getenv("FORECAST_GRID_STEP", "1min"))
+grid_horizon = pd.Timedelta(os.getenv("FORECAST_GRID_HORIZON", "24h"))
+
+class ForecastGrid:
+    # yhat materialized on a regular grid, start and step are in epoch seconds
+    def __init__(self, start: int, step: int, values: np.ndarray, generation: int):
+        self.start = start
+        self.step = step
+        self.values = values
+        self.generation = generation
+
+    @property
+    def end(self) -> int:
+        return self.start + (len(self.values) - 1) * self.step
+
+    def covers(self, ts: float) -> bool:
+        return self.start <= ts <= self.end
+
+    def value_at(self, ts: float) -> float:
+        pos = (ts - self.start) / self.step
+        i = min(int(pos), len(self.values) - 2)
+        frac = pos - i
+        return float(self.values[i] * (1 - frac) + self.values[i + 1] * frac)
+
+grids = {}
+grids_lock = threading.Lock()
+build_locks = {}
+
+def utc_now() -> datetime:
+    # naive like the timestamps of the samples, which are UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def to_epoch(ts) -> float:
+    return pd.Timestamp(ts).value / 1e9
+
+def build_grid(name: str, start: datetime | None = None) -> ForecastGrid:
+    step = int(grid_step.total_seconds())
+    points = max(int(grid_horizon.total_seconds() // step) + 1, 2)
+    if start is None:
+        start = utc_now()
+    start_ts = int(to_epoch(start)) // step * step
+    current = generation(name)
+    ds = pd.to_datetime(start_ts + np.arange(points, dtype=np.int64) * step, unit="s")
+    values = forecast_yhat(name, ds).astype(np.float32)
+    grid = ForecastGrid(start=start_ts, step=step, values=values, generation=current)
+    with grids_lock:
+        grids[name] = grid
+    return grid
+
+def refresh_grid(name: str):
+    with grids_lock:
+        grids.pop(name, None)
+    return build_grid(name)
+
+def drop_grid(name: str):
+    with grids_lock:
+        grids.pop(name, None)
+
+def get_value(name: str, at: datetime | None, ahead: pd.Timedelta) -> tuple[datetime, float]:
+    target = pd.Timestamp(at if at is not None else utc_now()) + ahead
+    ts = to_epoch(target)
+    grid = grids.get(name)
+    if grid is None or grid.generation != generation(name) or not grid.covers(ts):
+        with grids_lock:
+            lock = build_locks.setdefault(name, threading.Lock())
+        with lock:
+            grid = grids.get(name)
+            if grid is None or grid.generation != generation(name) or not grid.covers(ts):
+                # regenerate lazily, the new grid starts at the requested time
+                grid = build_grid(name, start=target.to_pydatetime())
+    return target.to_pydatetime(), grid.value_at(ts)
+
+def grid_stats() -> dict:
+    with grids_lock:
+        return {
+            "entries": len(grids),
+            "bytes": sum(g.values.nbytes for g in grids.values()),
+            "step_seconds": int(grid_step.total_seconds()),
+            "horizon_seconds": int(grid_horizon.total_seconds()),
+        }
@@ -0,0 +1,150 @@
+import os
+import csv
+import json
+import math
+from datetime import datetime
+
+max_reported_errors = 10
+# parsed rows are written in chunks of this size while the body is still being received
+ingest_chunk_rows = int(os.getenv("INGEST_CHUNK_ROWS", "10000"))
+
+class PartialIngest(Exception):
+    # the body failed after some of its rows were already committed
+    def __init__(self, result: "IngestResult", error: Exception):
+        super().__init__(str(error))
+        self.result = result
+
+class IngestResult:
+    def __init__(self, skip=None):
+        # skip(model name) returns why the samples of the model are not stored or None
+        self.skip = skip
+        self.rows = []
+        self.flushed = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_no, reason):
+        self.rejected += 1
+        if len(self.errors) < max_reported_errors:
+            self.errors.append(f"item {line_no}: {reason}")
+
+    def add(self, row):
+        reason = self.skip(row[0]) if self.skip is not None else None
+        if reason:
+            raise ValueError(reason)
+        self.rows.append(row)
+
+    def summary(self) -> dict:
+        return {"accepted": self.flushed + len(self.rows), "rejected": self.rejected, "errors": self.errors}
+
+    async def flush(self, write):
+        if self.rows:
+            await write(self.rows)
+            self.flushed += len(self.rows)
+            self.rows = []
+
+def parse_point(item, model: str | None):
+    # returns (name, datetime, value) or raises ValueError
+    if isinstance(item, dict):
+        name = model if model is not None else item.get("model")
+        date, value = item.get("date"), item.get("value")
+    elif isinstance(item, (list, tuple)):
+        if model is None:
+            if len(item) != 3:
+                raise ValueError("expected model,date,value")
+            name, date, value = item
+        else:
+            if len(item) != 2:
+                raise ValueError("expected date,value")
+            name, (date, value) = model, item
+    else:
+        raise ValueError("unexpected item type")
+    if not name:
+        raise ValueError("missing model")
+    if date is None or value is None:
+        raise ValueError("missing date or value")
+    ts = datetime.fromisoformat(str(date).strip())
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("value is not a finite number")
+    return str(name).strip(), ts, value
+
+def body_format(content_type: str | None, head: bytes) -> str:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines"):
+        return "ndjson"
+    if content_type in ("text/csv", "application/csv"):
+        return "csv"
+    if content_type == "application/json" or head.lstrip().startswith(b"["):
+        return "json"
+    return "ndjson" if head.lstrip().startswith(b"{") else "csv"
+
+def parse_json_array(body: bytes, model: str | None, result: IngestResult):
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError("expected a JSON array")
+    for i, item in enumerate(items):
+        try:
+            result.add(parse_point(item, model))
+        except (ValueError, TypeError) as e:
+            result.reject(i, e)
+
+def parse_line(line: str, line_no: int, fmt: str, model: str | None, result: IngestResult):
+    # for csv an optional header (date,value or model,date,value) on the first line is skipped
+    if not line.strip():
+        return
+    try:
+        if fmt == "csv":
+            item = next(csv.reader([line]))
+            if line_no == 0 and [c.strip().lower() for c in item][-2:] == ["date", "value"]:
+                return
+        else:
+            item = json.loads(line)
+        result.add(parse_point(item, model))
+    except (ValueError, TypeError) as e:
+        result.reject(line_no, e)
+
+async def read_lines(request):
+    # yields decoded lines as the body is being received
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if pending:
+        yield pending.decode("utf-8").rstrip("\r")
+
+async def parse_request(request, model: str | None, write=None, chunk_rows: int = ingest_chunk_rows, skip=None) -> IngestResult:
+    # write is awaited with each chunk of parsed rows, without it all of them are collected in result.rows
+    result = IngestResult(skip)
+    try:
+        return await parse_stream(request, model, write, chunk_rows, result)
+    except Exception as e:
+        if result.flushed:
+            raise PartialIngest(result, e) from e
+        raise
+
+async def parse_stream(request, model: str | None, write, chunk_rows: int, result: IngestResult) -> IngestResult:
+    stream = read_lines(request)
+    fmt = None
+    line_no = 0
+    async for line in stream:
+        if fmt is None:
+            if not line.strip():
+                continue
+            fmt = body_format(request.headers.get("content-type"), line.encode("utf-8"))
+            if fmt == "json":
+                # a JSON array can't be parsed line by line
+                rest = [line async for line in stream]
+                parse_json_array("\n".join([line] + rest).encode("utf-8"), model, result)
+                if write is not None:
+                    await result.flush(write)
+                return result
+        parse_line(line, line_no, fmt, model, result)
+        line_no += 1
+        if write is not None and len(result.rows) >= chunk_rows:
+            await result.flush(write)
+    if write is not None:
+        await result.flush(write)
+    return result
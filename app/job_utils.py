@@ -0,0 +1,169 @@
+import os
+import asyncio
+import heapq
+import itertools
+import threading
+import traceback
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pydantic import BaseModel
+from .model_utils import model_file, bump_generation
+from .grid_utils import refresh_grid
+from .db_utils import retrain_and_save
+from .metrics_utils import record_fit
+
+training_concurrency = int(os.getenv("TRAINING_CONCURRENCY", "1"))
+jobs_history = int(os.getenv("JOBS_HISTORY", "200"))
+
+class Job(BaseModel):
+    id: str
+    model: str
+    kind: str = "retrain"
+    state: str = "queued" # queued, running, done or failed
+    priority: float = 0
+    created: datetime
+    started: datetime | None = None
+    finished: datetime | None = None
+    duration: float | None = None
+    error: str | None = None
+    result: dict | None = None
+
+jobs = {}
+queued_by_model = {}
+queue = []
+seq = itertools.count()
+running = 0
+cond = threading.Condition()
+done_events = {}
+done_callbacks = {}
+executor = None
+dispatcher = None
+
+def run_retrain(model_name):
+    # runs in the worker process
+    return retrain_and_save(model_name)
+
+def last_fit_time(model_name) -> float:
+    try:
+        return os.path.getmtime(model_file(model_name))
+    except OSError:
+        return 0
+
+def get_executor():
+    global executor
+    if executor is None:
+        # spawn, because forking a process with running threads (uvicorn, dispatcher) is not safe
+        executor = ProcessPoolExecutor(max_workers=training_concurrency, mp_context=multiprocessing.get_context("spawn"))
+    return executor
+
+def submit_retrain(model_name, kind="retrain") -> Job:
+    global dispatcher
+    with cond:
+        job_id = queued_by_model.get(model_name)
+        if job_id is not None:
+            return jobs[job_id]
+        # the model that was trained the longest time ago goes first
+        job = Job(id=uuid.uuid4().hex, model=model_name, kind=kind, priority=last_fit_time(model_name), created=datetime.now())
+        jobs[job.id] = job
+        done_events[job.id] = threading.Event()
+        queued_by_model[model_name] = job.id
+        heapq.heappush(queue, (job.priority, next(seq), job.id))
+        trim_history()
+        if dispatcher is None:
+            dispatcher = threading.Thread(target=dispatch, name="training-dispatcher", daemon=True)
+            dispatcher.start()
+        cond.notify_all()
+        return job
+
+def dispatch():
+    global running
+    while True:
+        with cond:
+            while not queue or running >= training_concurrency:
+                cond.wait()
+            _, _, job_id = heapq.heappop(queue)
+            job = jobs[job_id]
+            queued_by_model.pop(job.model, None)
+            job.state = "running"
+            job.started = datetime.now()
+            running += 1
+        try:
+            future = get_executor().submit(run_retrain, job.model)
+        except Exception as e:
+            finish(job, None, e)
+            continue
+        future.add_done_callback(lambda f, job=job: on_done(job, f))
+
+def on_done(job: Job, future):
+    error = future.exception()
+    result = None if error else future.result()
+    if error is None:
+        bump_generation(job.model)
+        try:
+            refresh_grid(job.model)
+        except Exception:
+            print(traceback.format_exc())
+    finish(job, result, error)
+
+def finish(job: Job, result, error):
+    global running, executor
+    with cond:
+        job.finished = datetime.now()
+        job.duration = (job.finished - job.started).total_seconds()
+        if error is None:
+            job.state = "done"
+            job.result = result if isinstance(result, dict) else None
+            print(f"✅ Job {job.id} ({job.kind} {job.model}) finished in {job.duration:.2f}s")
+        else:
+            job.state = "failed"
+            job.error = str(error) or type(error).__name__
+            print(f"Job {job.id} ({job.kind} {job.model}) failed: {job.error}")
+            if isinstance(error, BrokenProcessPool):
+                executor = None
+        running -= 1
+        record_fit(job.model, job.result, job.state)
+        done_events.pop(job.id).set()
+        for callback in done_callbacks.pop(job.id, []):
+            callback()
+        cond.notify_all()
+
+def wait_for(job_id, timeout=None) -> Job:
+    event = done_events.get(job_id)
+    if event is not None:
+        event.wait(timeout)
+    return jobs[job_id]
+
+async def wait_async(job_id) -> Job:
+    # same as wait_for, but doesn't block a thread while the job runs
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def done():
+        if not future.done():
+            future.set_result(None)
+    with cond:
+        if job_id not in done_events:
+            return jobs[job_id]
+        done_callbacks.setdefault(job_id, []).append(lambda: loop.call_soon_threadsafe(done))
+    await future
+    return jobs[job_id]
+
+def get_job(job_id) -> Job | None:
+    return jobs.get(job_id)
+
+def list_jobs() -> list[Job]:
+    with cond:
+        return sorted(jobs.values(), key=lambda j: j.created, reverse=True)
+
+def queue_depth() -> int:
+    return len(queue)
+
+def trim_history():
+    finished = [j for j in jobs.values() if j.state in ("done", "failed")]
+    if len(jobs) <= jobs_history or not finished:
+        return
+    finished.sort(key=lambda j: j.created)
+    for j in finished[:len(jobs) - jobs_history]:
+        del jobs[j.id]
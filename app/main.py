@@ -1,19 +1,47 @@
 # main.py
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import RedirectResponse, StreamingResponse
+import time
+imports_start = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 import logging
 import os
+import threading
 import traceback
+from contextlib import asynccontextmanager
+import pandas as pd
 from pydantic import BaseModel
 from typing import List
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from .common_utils import to_bool
-from .model_utils import generate_forecast, generate_graph_bytes
-from .db_utils import feed_db, retrain_and_save, insert_measurement, upsert_mod, list_models_db, delete, reset_database, init_database
+from .model_utils import generate_forecast, generate_graph_bytes, model_cache_stats, models_path, bump_generation, is_known_version
+from .store_utils import start_watcher
+from .scheduler_utils import start_scheduler, scheduler_stats, set_drift_provider
+from .async_utils import run_in, db_executor, predict_executor, single_flight
+from .backtest_utils import run_backtest, backtest_executor
+from .batch_utils import forecast_batch, batch_max_items
+from .graph_utils import history_resolution, graph_key, etag, etag_matches, bucket_start, render_async, graph_cache_stats
+from .grid_utils import get_value, grid_stats, drop_grid
+from .job_utils import Job, submit_retrain, wait_async, get_job, list_jobs
+from .metrics_utils import render_metrics, http_seconds, rejected_samples
+from .ingest_utils import parse_request, PartialIngest
+from .export_utils import export_formats, stream_export
+from .db_utils import record_forecasts, forecast_errors, forecast_drift
+from .db_utils import feed_db, insert_measurement, insert_measurements, export_chunks, load_series, first_timestamp, now_epoch, to_epoch, compact_database, start_compaction, upsert_mod, list_models_db, delete, reset_database, init_database
+from .aggregate_utils import get_aggregate, aggregate_forecast, derived_reason, validate as validate_aggregate
+from .startup_utils import phase, record_phase, preload, preload_models, startup_report
+
+# Prophet and matplotlib are not imported here, they're imported by the first training, graph or Prophet.predict fallback
+record_phase("imports", time.perf_counter() - imports_start)
+
+@asynccontextmanager
+async def lifespan(app):
+    init()
+    yield
 
-app = FastAPI(title="KEDA Prophet")
+app = FastAPI(title="KEDA Prophet", lifespan=lifespan)
 logger = logging.getLogger('uvicorn.info')
 db_ready = False
 
@@ -26,11 +54,35 @@ class CreateModelRequest(BaseModel):
     custom_seasonality_period: float | None = 0 # in days, so 1/24 represents hourly
     custom_seasonality_fourier_order: int | None = 0
     seasonality_mode: str | None = "additive" # 'additive' (default) or 'multiplicative'.
+    train_max_age_hours: float | None = 0 # train only on data not older than this (relative to the newest sample), 0 = all data
+    train_max_rows: int | None = 0 # train only on this many newest samples, 0 = all data
+    train_resolution_seconds: int | None = 0 # average the samples into buckets of this size before training, 0 = raw data
+    warm_start: str | None = "False" # initialize the fit from the params of the previous model
+    raw_retention_hours: float | None = 0 # raw samples older than this are rolled up into 5m/1h aggregates, 0 = RAW_RETENTION_HOURS
+    changepoint_prior_scale: float | None = 0.01 # flexibility of the trend, higher values follow the data more closely
+    six_hour_fourier_order: int | None = 10 # Fourier order of the built-in six-hour seasonality, 0 = disabled
+    members: List[str] | None = [] # an aggregate model, its forecast is the sum of the forecasts of these models
+    reconcile_weight: float | None = 0 # share of the aggregate's own model in its forecast, 0 = no data and no training of its own
+
+class BacktestRequest(BaseModel):
+    grid: dict[str, list] # e.g. {"changepoint_prior_scale": [0.001, 0.01, 0.1], "seasonality_mode": ["additive", "multiplicative"]}
+    cutoffs: int = 3 # number of rolling cutoffs, a horizon apart
+    horizon_hours: float = 24 # the candidates are evaluated on this much data after each cutoff
+    apply: bool = False # store the params of the best candidate and retrain the model
 
 class ForecastRequest(BaseModel):
     start_date: str  # e.g., "2025-05-01 00:00:00"
     periods: int     # Number of future hours to predict
 
+class BatchForecastItem(BaseModel):
+    model: str
+    start_date: str  # e.g., "2025-05-01 00:00:00"
+    periods: int
+    freq: str = "h"
+
+class BatchForecastRequest(BaseModel):
+    requests: List[BatchForecastItem]
+
 class MetricStoreRequest(BaseModel):
     date: str      # e.g., "2025-05-01 00:00:00"
     value: float   # Measured value
@@ -43,6 +95,37 @@ class ForecastPoint(BaseModel):
 class ForecastResponse(BaseModel):
     forecast: List[ForecastPoint]
 
+class BatchForecastResult(BaseModel):
+    model: str
+    forecast: List[ForecastPoint] | None = None
+    error: str | None = None
+
+class BatchForecastResponse(BaseModel):
+    results: List[BatchForecastResult]
+
+class ValueResponse(BaseModel):
+    ds: str
+    yhat: float
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the route template, so that model names don't end up in the labels
+        route = request.scope.get("route")
+        if route is not None:
+            http_seconds.labels(request.method, route.path, str(status)).observe(time.perf_counter() - start)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
+
 @app.get("/", include_in_schema=False)
 def docs_redirect():
     return RedirectResponse(url='/docs')
@@ -52,6 +135,10 @@ def docs_redirect():
 @app.put("/models", include_in_schema=False)
 @app.put("/models/", include_in_schema=False)
 def upsert_model(request: CreateModelRequest):
+    try:
+        validate_aggregate(request.name, request.members or [], request.reconcile_weight or 0)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
         upsert_mod(request)
         return {"message": f"Model params for model {request.name} have been stored."}
@@ -60,45 +147,194 @@ def upsert_model(request: CreateModelRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def forecast_points(start_date, periods, model):
+    if get_aggregate(model) is not None:
+        forecast_df = aggregate_forecast(start_date, periods, model)
+    else:
+        forecast_df = generate_forecast(start_date, periods, model)
+    return [
+        ForecastPoint(
+            ds=row.ds.strftime("%Y-%m-%d %H:%M:%S"),
+            yhat=round(row.yhat, 2)
+        ) for row in forecast_df.itertuples()
+    ]
+
 @app.post("/models/{model}/predict", response_model=ForecastResponse)
-def predict(model, request: ForecastRequest):
-    try:
-        forecast_df = generate_forecast(request.start_date, request.periods, model)
-        response = [
-            ForecastPoint(
-                ds=row.ds.strftime("%Y-%m-%d %H:%M:%S"),
-                yhat=round(row.yhat, 2)
-            ) for row in forecast_df.itertuples()
-        ]
+async def predict(model, request: ForecastRequest, background_tasks: BackgroundTasks):
+    try:
+        # identical concurrent requests share one computation
+        key = ("predict", model, request.start_date, request.periods)
+        response = await single_flight.do(key, lambda: run_in(predict_executor, forecast_points, request.start_date, request.periods, model))
+        # kept until the actual values arrive, for the error statistics
+        background_tasks.add_task(record_forecasts, model, [p.ds for p in response], [p.yhat for p in response])
         return {"forecast": response}
     except Exception as e:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/predict:batch", response_model=BatchForecastResponse)
+async def predict_batch(request: BatchForecastRequest):
+    if len(request.requests) > batch_max_items:
+        raise HTTPException(status_code=400, detail=f"At most {batch_max_items} requests per batch")
+    try:
+        results = await run_in(predict_executor, forecast_batch, request.requests)
+        response = []
+        for item, result in zip(request.requests, results):
+            if "error" in result:
+                response.append(BatchForecastResult(model=item.model, error=result["error"]))
+                continue
+            response.append(BatchForecastResult(model=item.model, forecast=[
+                ForecastPoint(ds=ds, yhat=yhat) for ds, yhat in zip(result["ds"], result["yhat"])
+            ]))
+        return {"results": response}
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/models/{model}/value", response_model=ValueResponse)
+async def value(model, background_tasks: BackgroundTasks, at: str | None = None, ahead: str = "0min"):
+    try:
+        at_dt = datetime.strptime(at, "%Y-%m-%d %H:%M:%S") if at else None
+        ds, yhat = await run_in(predict_executor, get_value, model, at_dt, pd.Timedelta(ahead))
+        background_tasks.add_task(record_forecasts, model, [ds], [yhat])
+        return ValueResponse(ds=ds.strftime("%Y-%m-%d %H:%M:%S"), yhat=round(yhat, 2))
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/models/{model}/errors")
+async def errors(model):
+    # how good the served forecasts were, per horizon
+    try:
+        return await run_in(db_executor, forecast_errors, model)
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/models/{model}/retrain")
-def retrain(model):
+async def retrain(model, wait: bool = False):
+    reason = await run_in(db_executor, derived_reason, model)
+    if reason:
+        raise HTTPException(status_code=400, detail=reason)
     try:
-        retrain_and_save(model)
-        return {"message": f"Model {model} have been retrained to fit the data in the db"}
+        if wait:
+            # concurrent waiting callers share one training job
+            job = await single_flight.do(("retrain", model), lambda: wait_async(submit_retrain(model).id))
+            if job.state == "failed":
+                raise Exception(job.error)
+            return {"message": f"Model {model} have been retrained to fit the data in the db", "job_id": job.id}
+        job = submit_retrain(model)
+        return {"message": f"Retraining of model {model} has been scheduled", "job_id": job.id}
     except Exception as e:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/models/{model}/backtest")
+async def backtest(model, request: BacktestRequest):
+    try:
+        result = await run_in(backtest_executor, run_backtest, model, request.grid, request.cutoffs, request.horizon_hours)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+    best_params = result.pop("best_params")
+    result["applied"] = False
+    if request.apply and best_params is not None:
+        try:
+            # goes through the same path as POST /models, the training window settings are kept
+            row = best_params.model_dump(exclude={"has_custom_seasonality"})
+            for field in ("yearly_seasonality", "weekly_seasonality", "daily_seasonality", "warm_start"):
+                row[field] = str(row[field])
+            await run_in(db_executor, upsert_mod, CreateModelRequest(name=model, **row))
+            result["applied"] = True
+            result["job_id"] = submit_retrain(model).id
+        except Exception as e:
+            print(traceback.format_exc())
+            raise HTTPException(status_code=500, detail=str(e))
+    return result
+
+@app.get("/jobs", response_model=List[Job])
+async def jobs():
+    return list_jobs()
+
+@app.get("/scheduler")
+async def scheduler():
+    return await run_in(db_executor, scheduler_stats)
+
+@app.get("/jobs/{job_id}", response_model=Job)
+async def job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
 @app.post("/models/{model}/metrics")
-def feed_measurement(model, request: MetricStoreRequest):
+async def feed_measurement(model, request: MetricStoreRequest):
+    reason = await run_in(db_executor, derived_reason, model)
+    if reason:
+        raise HTTPException(status_code=400, detail=reason)
     try:
-        insert_measurement(model, request.date, request.value)
+        await run_in(db_executor, insert_measurement, model, request.date, request.value)
         return {"message": "ack"}
     except Exception as e:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+class BatchIngestResponse(BaseModel):
+    accepted: int
+    rejected: int
+    errors: List[str]
+
+async def ingest_batch(request: Request, model: str | None):
+    try:
+        # rows are inserted in chunks while the body is streaming in, each chunk in its own transaction
+        # the samples of derived aggregates are rejected, the definitions are refreshed here and not on the event loop
+        await run_in(db_executor, get_aggregate, "")
+        result = await parse_request(request, model, write=lambda rows: run_in(db_executor, insert_measurements, rows), skip=derived_reason)
+        rejected_samples.inc(result.rejected)
+        return result.summary()
+    except PartialIngest as e:
+        # the rows committed before the error are reported, so that they aren't sent again
+        print(traceback.format_exc())
+        rejected_samples.inc(e.result.rejected)
+        raise HTTPException(status_code=500, detail={"message": str(e), "accepted": e.result.flushed, "rejected": e.result.rejected, "errors": e.result.errors})
+    except ValueError as e:
+        # e.g. a malformed JSON array before anything was stored, the other formats report the bad lines in errors
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+# body is either a JSON array of {"date", "value"} objects, NDJSON or CSV with date,value lines
+@app.post("/models/{model}/metrics/batch", response_model=BatchIngestResponse)
+async def feed_measurements(model, request: Request):
+    return await ingest_batch(request, model)
+
+# same as above, but each item also carries the model name ({"model", "date", "value"} or model,date,value)
+@app.post("/metrics/batch", response_model=BatchIngestResponse)
+async def feed_measurements_multi(request: Request):
+    return await ingest_batch(request, None)
+
+# streams the stored data of a model (raw samples and the rollups before them) as NDJSON or CSV,
+# since (inclusive) and until (exclusive) are "%Y-%m-%d %H:%M:%S"
+@app.get("/models/{model}/metrics")
+def export_measurements(model, since: str | None = None, until: str | None = None, format: str = "ndjson"):
+    if format not in export_formats:
+        raise HTTPException(status_code=400, detail=f"Unsupported format {format}, use one of {', '.join(export_formats)}")
+    try:
+        chunks = export_chunks(model, since=to_epoch(since) if since else None, until=to_epoch(until) if until else None)
+        return StreamingResponse(stream_export(chunks, format), media_type=export_formats[format])
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/models", response_model=List[str])
 @app.get("/models/", include_in_schema=False, response_model=List[str])
-def list_models():
+async def list_models():
     import traceback
     try:
-        models = list_models_db()
+        models = await run_in(db_executor, list_models_db)
         return models
     except Exception as e:
         print(traceback.format_exc())
@@ -122,8 +358,20 @@ def reset_db():
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cacheStats")
+def cache_stats():
+    return {"models": model_cache_stats(), "grids": grid_stats(), "graphs": graph_cache_stats(), "single_flight": single_flight.stats()}
+
+@app.get("/compactDb")
+def compact_db():
+    try:
+        return compact_database()
+    except Exception as e:
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/models/{model}/testData")
-def feed_test_data(model,days=14, daysTrendFactor=1.1, offHoursFactor=0, jitter=.05):
+def feed_test_data(model, days: int = 14, daysTrendFactor: float = 1.1, offHoursFactor: float = 0, jitter: float = .05):
     try:
         feed_db(
             model=model,
@@ -145,17 +393,12 @@ def feed_test_data(model,days=14, daysTrendFactor=1.1, offHoursFactor=0, jitter=
         }
     }
 )
-def graph(model, legend = "F", trend = "F", uncertainty = "T", hoursAgo: int = 0, dataHoursAgo: int = 0, freq: str = "10min", periods: int = 60):
-    try:
-        if hoursAgo > 0:
-            prediction_start_time = (datetime.today() - timedelta(hours=hoursAgo)).strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            prediction_start_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-        if dataHoursAgo > 0:
-            data_start_time = (datetime.today() - timedelta(hours=dataHoursAgo)).strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            data_start_time = None
-        image_bytes = generate_graph_bytes(
+async def graph(request: Request, model, legend = "F", trend = "F", uncertainty = "T", hoursAgo: int = 0, dataHoursAgo: int = 0, freq: str = "10min", periods: int = 60):
+    try:
+        # start times are aligned to freq, so that the rendered image can be reused until the next bucket
+        prediction_start_time = bucket_start(max(hoursAgo, 0), freq)
+        data_start_time = bucket_start(dataHoursAgo, freq) if dataHoursAgo > 0 else None
+        params = dict(
             data_start_date=data_start_time,
             prediction_start_date = prediction_start_time,
             include_legend = to_bool(legend),
@@ -165,7 +408,17 @@ def graph(model, legend = "F", trend = "F", uncertainty = "T", hoursAgo: int = 0
             name = model,
             freq = freq,
         )
-        return StreamingResponse(image_bytes, media_type="image/png")
+        key = graph_key("graph", **params)
+        tag = etag(key)
+        if etag_matches(request.headers.get("if-none-match"), tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        def draw():
+            since = to_epoch(data_start_time) if data_start_time else first_timestamp(model)
+            resolution = history_resolution(now_epoch() - since) if since is not None else 0
+            history = load_series(model, since=to_epoch(data_start_time) if data_start_time else None, resolution=resolution)
+            return generate_graph_bytes(**params, history=history)
+        png = await render_async(key, draw)
+        return Response(png, media_type="image/png", headers={"ETag": tag, "Cache-Control": "no-cache"})
     except Exception as e:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e) + ". Make sure you call the /metrics and /retrain endpoints first")
@@ -178,15 +431,11 @@ def graph(model, legend = "F", trend = "F", uncertainty = "T", hoursAgo: int = 0
         }
     }
 )
-def graph_components(model, uncertainty = "1", hoursAgo: int = 0, freq: str = "10min", periods: int = 60):
+async def graph_components(request: Request, model, uncertainty = "1", hoursAgo: int = 0, freq: str = "10min", periods: int = 60):
     try:
-        if hoursAgo > 0:
-            prediction_start_time = (datetime.today() - timedelta(hours=hoursAgo)).strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            prediction_start_time = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-        image_bytes = generate_graph_bytes(
+        params = dict(
             data_start_date=None,
-            prediction_start_date = prediction_start_time,
+            prediction_start_date = bucket_start(max(hoursAgo, 0), freq),
             include_legend = False,
             uncertainty = to_bool(uncertainty),
             trend=False,
@@ -195,7 +444,12 @@ def graph_components(model, uncertainty = "1", hoursAgo: int = 0, freq: str = "1
             freq = freq,
             components = True,
         )
-        return StreamingResponse(image_bytes, media_type="image/png")
+        key = graph_key("graphComponents", **params)
+        tag = etag(key)
+        if etag_matches(request.headers.get("if-none-match"), tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        png = await render_async(key, lambda: generate_graph_bytes(**params))
+        return Response(png, media_type="image/png", headers={"ETag": tag, "Cache-Control": "no-cache"})
     except Exception as e:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e) + ". Make sure you call the /metrics and /retrain endpoints first")
@@ -204,7 +458,7 @@ def graph_components(model, uncertainty = "1", hoursAgo: int = 0, freq: str = "1
 async def readiness_probe():
     global db_ready
     if db_ready:
-        return {"status": "ready"}
+        return {"status": "ready", "startup": startup_report()}
     raise HTTPException(status_code=503, detail="Not ready yet")
 
 @app.get("/liveness", include_in_schema=False)
@@ -218,13 +472,36 @@ class EndpointFilter(logging.Filter):
 # exclude endpoints /liveness & /readiness from logs
 logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
+def model_changed(name):
+    # a model was published or deleted by another worker, the cached model is revalidated anyway, the grid isn't.
+    # the versions trained by this worker were already handled by job_utils.on_done
+    if is_known_version(name):
+        return
+    bump_generation(name)
+    drop_grid(name)
+
 def init():
     global db_ready
     logger.info("KEDA Prophet API is starting up")
     logger.info("-------------------------------")
     logger.info(f"Version: {os.getenv("VERSION", "main")}")
     logger.info(f"Git Sha: {os.getenv("GIT_SHA", "main")}")
-    init_database()
-    db_ready = True
+    with phase("database"):
+        init_database()
+    with phase("background threads"):
+        start_compaction()
+        start_watcher(models_path, model_changed)
+        set_drift_provider(forecast_drift)
+        start_scheduler()
+    # not ready until the preloaded models are in memory, the probes are served meanwhile
+    threading.Thread(target=warm_up, name="preload", daemon=True).start()
 
-init()
+def warm_up():
+    global db_ready
+    if preload_models:
+        result = preload(preload_models, models_path)
+        logger.info(f"Preloaded {len(result['loaded'])} models" + (f", failed: {', '.join(result['failed'])}" if result["failed"] else ""))
+    db_ready = True
+    for p in startup_report()["phases"]:
+        logger.info(f"Startup phase {p['phase']}: {p['seconds'] * 1000:.1f} ms")
+    logger.info(f"✅ Ready after {startup_report()['total_seconds'] * 1000:.1f} ms")
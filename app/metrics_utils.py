@@ -0,0 +1,79 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# everything is exposed by GET /metrics, training runs in worker processes, so its metrics are recorded when the job finishes
+
+# most of the hot paths are sub-millisecond, fits and renders take seconds
+fast_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+slow_buckets = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+model_load_seconds = Histogram("keda_prophet_model_load_seconds", "Loading a model from disk", ["format"], buckets=fast_buckets)
+predict_seconds = Histogram("keda_prophet_predict_seconds", "Computing a forecast", ["path"], buckets=fast_buckets)
+fit_seconds = Histogram("keda_prophet_fit_seconds", "Fitting a model", buckets=slow_buckets)
+sql_seconds = Histogram("keda_prophet_sql_seconds", "Database calls", ["query"], buckets=fast_buckets)
+render_seconds = Histogram("keda_prophet_render_seconds", "Rendering a graph into PNG", ["kind"], buckets=slow_buckets)
+http_seconds = Histogram("keda_prophet_http_request_seconds", "HTTP requests", ["method", "path", "status"], buckets=fast_buckets)
+
+ingested_samples = Counter("keda_prophet_ingested_samples", "Samples written to the database", ["model"])
+rejected_samples = Counter("keda_prophet_rejected_samples", "Samples rejected by the batch endpoints")
+training_jobs = Counter("keda_prophet_training_jobs", "Finished training jobs", ["state"])
+training_rows = Gauge("keda_prophet_training_rows", "Number of rows the current model was fitted on", ["model"])
+training_iterations = Gauge("keda_prophet_training_iterations", "Optimizer iterations of the last fit", ["model"])
+
+def timed(histogram, *labels):
+    # works both as a decorator and as a context manager: @timed(sql_seconds, "get_model") or with timed(...):
+    return histogram.labels(*labels).time() if labels else histogram.time()
+
+def record_fit(model_name, stats: dict | None, state: str):
+    training_jobs.labels(state).inc()
+    if stats:
+        fit_seconds.observe(stats["fit_seconds"])
+        training_rows.labels(model_name).set(stats["rows"])
+        if stats.get("iterations") is not None:
+            training_iterations.labels(model_name).set(stats["iterations"])
+
+def forget_model(model_name):
+    for metric in (ingested_samples, training_rows, training_iterations):
+        try:
+            metric.remove(model_name)
+        except KeyError:
+            pass
+
+class StateCollector:
+    # values that are read when scraped: caches, training queue and model files
+    def describe(self):
+        # otherwise the registry calls collect() on registration, before the modules it reads are imported
+        return []
+
+    def collect(self):
+        from .model_utils import model_cache_stats, models_path
+        from .store_utils import current_models
+        from .graph_utils import graph_cache_stats
+        from .grid_utils import grid_stats
+        from .job_utils import queue_depth, running
+        ratio = GaugeMetricFamily("keda_prophet_cache_hit_ratio", "Hit ratio of the caches", labels=["cache"])
+        entries = GaugeMetricFamily("keda_prophet_cache_entries", "Entries in the caches", labels=["cache"])
+        size = GaugeMetricFamily("keda_prophet_cache_bytes", "Approximate size of the caches", labels=["cache"])
+        for name, stats in (("models", model_cache_stats()), ("graphs", graph_cache_stats())):
+            ratio.add_metric([name], stats["hit_ratio"])
+            entries.add_metric([name], stats["entries"])
+            size.add_metric([name], stats["bytes"])
+        grids = grid_stats()
+        entries.add_metric(["grids"], grids["entries"])
+        size.add_metric(["grids"], grids["bytes"])
+        yield from (ratio, entries, size)
+        yield GaugeMetricFamily("keda_prophet_training_queue_depth", "Training jobs waiting in the queue", value=queue_depth())
+        yield GaugeMetricFamily("keda_prophet_training_running", "Training jobs being run", value=running)
+        files = GaugeMetricFamily("keda_prophet_model_file_bytes", "Size of the serialized models", labels=["model", "format"])
+        for name, path in current_models(models_path).items():
+            try:
+                files.add_metric([name, os.path.splitext(path)[1][1:]], os.path.getsize(path))
+            except FileNotFoundError:
+                pass
+        yield files
+
+REGISTRY.register(StateCollector())
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,55 +1,147 @@
 import io
 import os
 import os.path
+import numpy as np
 import pandas as pd
 import logging
 logging.getLogger("prophet.plot").disabled = True
-from prophet import Prophet
-from prophet.plot import add_changepoints_to_plot
 from pydantic import BaseModel
 import pickle
+import copy
 from datetime import datetime, timedelta
-import matplotlib
 import traceback
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+import threading
+import time
+from .cache_utils import LRUCache
+from .predict_utils import fast_predict, get_predictor, to_us, UnsupportedModel
+from .metrics_utils import timed, model_load_seconds, predict_seconds
+from .serialize_utils import save_bundle, load_bundle_model, compare_formats, to_prophet
+from .store_utils import pointer_file, legacy_files, resolve, publish, remove_all
+from .common_utils import to_bool
 
 
 models_path = os.getenv("MODELS_PATH", "model/")
+# npz (compact bundle, see serialize_utils) or pickle, models in either format are loaded
+model_format = os.getenv("MODEL_FORMAT", "npz")
+
+# process-wide cache of loaded models, the size of an entry is approximated by the size of the file on disk
+model_cache = LRUCache(
+    max_entries=int(os.getenv("MODEL_CACHE_MAX_ENTRIES", "32")),
+    max_bytes=int(os.getenv("MODEL_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+)
+# bumped on each train/delete so that cached entries are dropped even if the mtime doesn't change
+model_generations = {}
+# the version (path) of each model at its last bump, so that the watcher skips the versions this process already knows
+model_versions = {}
+generations_lock = threading.Lock()
+# pyplot keeps global state and isn't thread-safe
+plot_lock = threading.Lock()
 
 # Load model
 # with open("model/prophet.json", "rb") as fjson:
 #     model = model_from_json(fjson.read())
 
-def generate_forecast(start_date: str, periods: int, name: str) -> pd.DataFrame:
-    with open(f"{models_path}/prophet-{name}.pkl", "rb") as f:
-        model = pickle.load(f)
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
+def model_file(name):
+    # the current version of the model (see store_utils), or the path it would have in the old layout
+    p = resolve(models_path, name)
+    if p is None:
+        npz, pkl = legacy_files(models_path, name)
+        return npz if model_format == "npz" else pkl
+    return p
+
+def get_generation(name):
+    return model_generations.get(name, 0)
+
+def bump_generation(name):
+    with generations_lock:
+        model_generations[name] = model_generations.get(name, 0) + 1
+        model_versions[name] = resolve(models_path, name)
+    model_cache.invalidate(name)
+
+def is_known_version(name) -> bool:
+    # whether the current version of the model (or its deletion) was already seen by a bump in this process
+    return name in model_versions and model_versions[name] == resolve(models_path, name)
+
+def model_validator(name):
+    # a new version replaces the pointer file, so its inode changes even if the mtime doesn't
+    try:
+        st = os.stat(pointer_file(models_path, name))
+    except FileNotFoundError:
+        st = os.stat(model_file(name))
+    return (st.st_ino, st.st_mtime_ns, st.st_size, get_generation(name))
+
+def load_model(name):
+    validator = model_validator(name)
+    model = model_cache.get(name, validator)
+    if model is None:
+        p = model_file(name)
+        st = os.stat(p)
+        if p.endswith(".npz"):
+            with timed(model_load_seconds, "npz"):
+                model = load_bundle_model(p)
+        else:
+            with timed(model_load_seconds, "pickle"), open(p, "rb") as f:
+                model = pickle.load(f)
+        model_cache.put(name, model, size=st.st_size, validator=validator)
+    return model
+
+def model_cache_stats():
+    return model_cache.stats()
+
+def generate_forecast(start_date: str, periods: int, name: str, fast: bool = fast_predict) -> pd.DataFrame:
+    model = load_model(name)
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
+
+    # Create future dataframe
+    future = pd.date_range(start=start_dt, periods=periods, freq="h")
+    if fast:
+        with timed(predict_seconds, "fast"):
+            return pd.DataFrame({"ds": future, "yhat": predict_yhat(model, future)})
+    future_df = pd.DataFrame({"ds": future})
 
-        # Create future dataframe
-        future = pd.date_range(start=start_dt, periods=periods, freq="h")
-        future_df = pd.DataFrame({"ds": future})
+    # Predict
+    with timed(predict_seconds, "prophet"):
+        forecast = to_prophet(model).predict(future_df)
 
-        # Predict
-        forecast = model.predict(future_df)
+    # Filter required fields (yhat and ds are names expected by prophet)
+    return forecast[["ds", "yhat"]]
 
-        # Filter required fields (yhat and ds are names expected by prophet)
-        return forecast[["ds", "yhat"]]
+def predict_yhat(model, ds, fast: bool = fast_predict) -> np.ndarray:
+    # same as model.predict(...)["yhat"], but skips the uncertainty intervals
+    if fast:
+        try:
+            return get_predictor(model).predict(to_us(ds))
+        except UnsupportedModel:
+            pass
+    model = to_prophet(model)
+    df = model.setup_dataframe(pd.DataFrame({"ds": ds}))
+    trend = np.asarray(model.predict_trend(df))
+    seasonal = model.predict_seasonal_components(df)
+    return trend * (1 + seasonal["multiplicative_terms"].values) + seasonal["additive_terms"].values
 
-def generate_graph_bytes(data_start_date: str|None, prediction_start_date: str, include_legend: bool, uncertainty: bool, trend: bool, periods: int, name: str, freq: str, components = False) -> pd.DataFrame:
-    with open(f"{models_path}/prophet-{name}.pkl", "rb") as f:
-        model = pickle.load(f)
-        # Create future dataframe
-        future = pd.date_range(start=prediction_start_date, periods=periods, freq=freq)
-        future_df = pd.DataFrame({"ds": future})
+def generate_graph_bytes(data_start_date: str|None, prediction_start_date: str, include_legend: bool, uncertainty: bool, trend: bool, periods: int, name: str, freq: str, components = False, history: pd.DataFrame | None = None) -> pd.DataFrame:
+    # plotting is only imported when the first graph is rendered, it's not needed for serving forecasts
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from prophet.plot import add_changepoints_to_plot
+    model = to_prophet(load_model(name))
+    if history is not None and len(history) > 0:
+        # plot the stored data instead of the training data, the cached model is shared so it's not modified
+        model = copy.copy(model)
+        model.history = history.assign(t=(history["ds"] - model.start) / model.t_scale)
+    # Create future dataframe
+    future = pd.date_range(start=prediction_start_date, periods=periods, freq=freq)
+    future_df = pd.DataFrame({"ds": future})
 
-        # Predict
-        forecast = model.predict(future_df)
+    # Predict
+    forecast = model.predict(future_df)
 
-            # bar = forecast[forecast["ds"] >= data_start_date]
+        # bar = forecast[forecast["ds"] >= data_start_date]
 
-        # print(bar)
+    # print(bar)
 
+    with plot_lock:
         if components:
             fig = model.plot_components(forecast, uncertainty=uncertainty)
         else:
@@ -65,47 +157,106 @@ def generate_graph_bytes(data_start_date: str|None, prediction_start_date: str,
         img_buf = io.BytesIO()
         fig.savefig(img_buf, format='png')
         plt.close(fig)
-        img_buf.seek(0)
+    img_buf.seek(0)
 
-        return img_buf
+    return img_buf
 
 def delete_serialized_model(model_name):
-    p = os.path.abspath(f"{models_path}/prophet-{model_name}.pkl")
     try:
-        os.remove(p)
-        print(f"✅ Model {p} was deleted")
+        for p in remove_all(models_path, model_name):
+            print(f"✅ Model {os.path.abspath(p)} was deleted")
     except Exception as e:
         print(traceback.format_exc())
+    # after the removal, so that the watcher knows the deletion
+    bump_generation(model_name)
 
-def train_and_save(model_name, params, df):
-    parsed_params: ModelParams = parseModelParams(params)
-    print(f"Training model {model_name} using following model params:")
-    print(parsed_params)
+def warm_start_init(model_name):
+    # fitted params of the previous model, Prophet ignores delta and beta if their shapes don't match anymore
+    try:
+        prev = load_model(model_name)
+    except FileNotFoundError:
+        return None, None
+    init = {
+        "k": float(np.nanmean(prev.params["k"])),
+        "m": float(np.nanmean(prev.params["m"])),
+        "sigma_obs": float(np.nanmean(prev.params["sigma_obs"])),
+        "delta": np.nanmean(prev.params["delta"], axis=0),
+        "beta": np.nanmean(prev.params["beta"], axis=0),
+    }
+    return init, getattr(prev, "fit_stats", None)
+
+def fit_iterations(model):
+    # cmdstan doesn't report the number of iterations other than in its console output
+    try:
+        with open(model.stan_fit.runset.stdout_files[0]) as f:
+            lines = f.read().splitlines()
+    except Exception:
+        return None
+    iterations = None
+    for line in lines:
+        cols = line.split()
+        if len(cols) > 1 and cols[0].isdigit():
+            iterations = int(cols[0])
+        elif line.startswith("Optimization terminated"):
+            break
+    return iterations
+
+def build_model(parsed_params: "ModelParams") -> "Prophet":
+    from prophet import Prophet
     model = Prophet(
-        changepoint_prior_scale=0.01,
+        changepoint_prior_scale=parsed_params.changepoint_prior_scale,
         yearly_seasonality=parsed_params.yearly_seasonality,
         weekly_seasonality=parsed_params.weekly_seasonality,
         daily_seasonality=parsed_params.daily_seasonality,
         seasonality_mode=parsed_params.seasonality_mode,
     )
     # by default, add six-hour seasonality
-    model.add_seasonality(name='six', period=6/24, fourier_order=10)
+    if parsed_params.six_hour_fourier_order > 0:
+        model.add_seasonality(name='six', period=6/24, fourier_order=parsed_params.six_hour_fourier_order)
     if parsed_params.has_custom_seasonality:
         model.add_seasonality(name='custom', period=parsed_params.custom_seasonality_period, fourier_order=parsed_params.custom_seasonality_fourier_order)
+    return model
+
+def train_and_save(model_name, parsed_params: "ModelParams", df):
+    print(f"Training model {model_name} using following model params:")
+    print(parsed_params)
+    init, prev_stats = warm_start_init(model_name) if parsed_params.warm_start else (None, None)
+    model = build_model(parsed_params)
     # Train model
-    model.fit(df)
+    start = time.perf_counter()
+    if init is not None:
+        model.fit(df, init=init)
+    else:
+        model.fit(df)
+    model.fit_stats = {
+        "rows": len(df),
+        "fit_seconds": round(time.perf_counter() - start, 3),
+        "iterations": fit_iterations(model),
+        "warm_start": init is not None,
+    }
 
-    # Save model
-    os.makedirs(models_path, exist_ok=True)
-    p = os.path.abspath(f"{models_path}/prophet-{model_name}.pkl")
-    with open(p, "wb") as f:
-        pickle.dump(model, f)
+    # Save model, as a new version that other processes pick up when the pointer to it is switched
+    def write_pickle(path):
+        with open(path, "wb") as f:
+            pickle.dump(model, f)
+    if model_format == "npz":
+        p = os.path.abspath(publish(models_path, model_name, "npz", lambda path: save_bundle(model, path)))
+    else:
+        p = os.path.abspath(publish(models_path, model_name, "pkl", write_pickle))
+    bump_generation(model_name)
     # with open("model/prophet.json", "w") as fjson:
     #     fjson.write(model_to_json(model))
 
     print(f"✅ Model trained and saved to {p}")
     print(f"Size on disk: {human_readable_size(os.path.getsize(p))}")
+    if model_format == "npz":
+        print(compare_formats(model, p))
     # print("✅ Model trained and saved to model/prophet.json")
+    stats = model.fit_stats
+    print(f"Fit of {stats['rows']} rows took {stats['fit_seconds']}s and {stats['iterations']} iterations (warm start: {stats['warm_start']})")
+    if prev_stats:
+        print(f"Previous fit of {prev_stats['rows']} rows took {prev_stats['fit_seconds']}s and {prev_stats['iterations']} iterations (warm start: {prev_stats['warm_start']})")
+    return {**stats, "previous": prev_stats}
 
 class ModelParams(BaseModel):
     yearly_seasonality: str | bool | int
@@ -115,6 +266,15 @@ class ModelParams(BaseModel):
     has_custom_seasonality: bool
     custom_seasonality_period: float
     custom_seasonality_fourier_order: int
+    train_max_age_hours: float = 0 # 0 means no limit
+    train_max_rows: int = 0 # 0 means no limit
+    train_resolution_seconds: int = 0 # 0 means no downsampling
+    warm_start: bool = False
+    raw_retention_hours: float = 0 # 0 means the global default
+    changepoint_prior_scale: float = 0.01
+    six_hour_fourier_order: int = 10 # 0 means no six-hour seasonality
+    members: list[str] = [] # an aggregate of these models, see aggregate_utils
+    reconcile_weight: float = 0 # 0 means the aggregate has no model of its own
 
 def parseModelParams(params):
     if params == None:
@@ -128,6 +288,15 @@ def parseModelParams(params):
         has_custom_seasonality=params[3] > 0 and params[4] > 0,
         custom_seasonality_period=params[3],
         custom_seasonality_fourier_order=params[4],
+        train_max_age_hours=params[6],
+        train_max_rows=params[7],
+        train_resolution_seconds=params[8],
+        warm_start=to_bool(params[9]),
+        raw_retention_hours=params[10],
+        changepoint_prior_scale=params[11],
+        six_hour_fourier_order=params[12],
+        members=[m for m in params[13].split(",") if m],
+        reconcile_weight=params[14],
     )
 
 def parseSeasonality(seasonality):
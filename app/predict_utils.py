@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import weakref
+import numpy as np
+
+# set to false to always go through Prophet.predict
+fast_predict = os.getenv("FAST_PREDICT", "true").lower() in ("true", "1", "yes", "on")
+
+us_per_day = 24 * 60 * 60 * 1e6
+
+class UnsupportedModel(Exception):
+    pass
+
+class FastPredictor:
+    # yhat of a fitted Prophet model evaluated with NumPy only: piecewise linear trend + Fourier seasonalities,
+    # same math as Prophet.predict without building the feature dataframes and without the uncertainty simulation
+    def __init__(self, model):
+        if model.growth not in ("linear", "flat"):
+            raise UnsupportedModel(f"{model.growth} growth")
+        if model.extra_regressors or model.train_holiday_names is not None:
+            raise UnsupportedModel("extra regressors or holidays")
+        self.start = model.start.value // 1000
+        self.t_scale = model.t_scale.value / 1000
+        self.y_scale = float(model.y_scale)
+        self.floor = float(model.y_min) if model.scaling == "minmax" else 0.0
+        self.flat = model.growth == "flat"
+        self.k = float(np.nanmean(model.params["k"]))
+        self.m = float(np.nanmean(model.params["m"]))
+        # trend slope and offset after each changepoint
+        deltas = np.nanmean(model.params["delta"], axis=0)
+        self.changepoints_t = np.asarray(model.changepoints_t, dtype=np.float64)
+        self.k_cum = np.concatenate([[0.0], np.cumsum(deltas)])
+        self.m_cum = np.concatenate([[0.0], np.cumsum(-deltas * self.changepoints_t)])
+        # seasonal features are generated in the order of model.seasonalities, the same as the rows of beta
+        beta = np.nanmean(model.params["beta"], axis=0)
+        # a BundleModel has the columns as arrays, without the train_component_cols dataframe
+        cols = getattr(model, "component_terms", None)
+        if cols is None:
+            cols = model.train_component_cols
+        self.beta_add = beta * np.asarray(cols["additive_terms"]) * self.y_scale
+        self.beta_mult = beta * np.asarray(cols["multiplicative_terms"])
+        self.orders = []
+        for name, props in model.seasonalities.items():
+            if props["condition_name"] is not None:
+                raise UnsupportedModel(f"conditional seasonality {name}")
+            self.orders.append((float(props["period"]), int(props["fourier_order"])))
+        # frequencies (cycles per day) of the interleaved sin/cos columns
+        self.freqs = np.concatenate([np.arange(1, o + 1) / p for p, o in self.orders]) if self.orders else np.empty(0)
+        if 2 * len(self.freqs) != len(beta):
+            raise UnsupportedModel("unexpected number of seasonal features")
+
+    def trend(self, ts_us: np.ndarray) -> np.ndarray:
+        t = (ts_us - self.start) / self.t_scale
+        if self.flat:
+            trend = np.full(len(t), self.m)
+        else:
+            i = np.searchsorted(self.changepoints_t, t, side="right")
+            trend = (self.k + self.k_cum[i]) * t + self.m + self.m_cum[i]
+        return trend * self.y_scale + self.floor
+
+    def features(self, ts_us: np.ndarray) -> np.ndarray:
+        x = 2 * np.pi * np.outer(ts_us / us_per_day, self.freqs)
+        out = np.empty((len(ts_us), 2 * len(self.freqs)))
+        out[:, 0::2] = np.sin(x)
+        out[:, 1::2] = np.cos(x)
+        return out
+
+    def predict(self, ts_us: np.ndarray, features: np.ndarray | None = None) -> np.ndarray:
+        # ts_us: epoch microseconds (int64), returns yhat, features can be shared by models with the same seasonalities
+        ts_us = np.asarray(ts_us, dtype=np.int64)
+        x = self.features(ts_us) if features is None else features
+        return self.trend(ts_us) * (1 + x @ self.beta_mult) + x @ self.beta_add
+
+predictors = weakref.WeakKeyDictionary()
+
+def get_predictor(model) -> FastPredictor:
+    # one per loaded model, it goes away with the model when it's evicted from the model cache
+    predictor = predictors.get(model)
+    if predictor is None:
+        predictor = FastPredictor(model)
+        predictors[model] = predictor
+    return predictor
+
+def to_us(ds) -> np.ndarray:
+    return np.asarray(ds, dtype="datetime64[us]").astype(np.int64)
+
+if __name__ == "__main__":
+    # correctness check against Prophet.predict, e.g.: python -m app.predict_utils model/prophet-test.pkl
+    import pickle
+    import pandas as pd
+    from .serialize_utils import load_bundle_model, to_prophet
+    path = sys.argv[1] if len(sys.argv) > 1 else "model/prophet-test.pkl"
+    if path.endswith(".npz"):
+        model = to_prophet(load_bundle_model(path))
+    else:
+        with open(path, "rb") as f:
+            model = pickle.load(f)
+    ds = pd.date_range(model.history["ds"].min(), periods=24 * 60 * 14, freq="min") + pd.Timedelta("7s")
+    start = time.perf_counter()
+    expected = model.predict(pd.DataFrame({"ds": ds}))["yhat"].values
+    prophet_time = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = FastPredictor(model).predict(to_us(ds))
+    fast_time = time.perf_counter() - start
+    error = np.max(np.abs(actual - expected))
+    tolerance = 1e-6 * max(1.0, np.max(np.abs(expected)))
+    print(f"{len(ds)} timestamps, max abs error {error:.3g}, Prophet.predict {prophet_time * 1000:.1f} ms, fast path {fast_time * 1000:.1f} ms")
+    if error > tolerance:
+        print(f"Fast path differs from Prophet.predict by more than {tolerance:.3g}")
+        sys.exit(1)
+    print("✅ Fast path matches Prophet.predict")
@@ -0,0 +1,81 @@
+import sys
+import time
+import argparse
+import numpy as np
+from datetime import date, datetime, timedelta, timezone
+
+# daily shapes, functions of the second of the day returning values roughly in 0..960
+shapes = {
+    # the original /testData pattern: ramps up every minute of the hour, restarting every 16 hours
+    "sawtooth": lambda sod: ((sod // 3600) % 16) * 60 + (sod % 3600) // 60,
+    "sine": lambda sod: 480 * (1 - np.cos(2 * np.pi * sod / 86400)),
+    "square": lambda sod: np.where((sod >= 8 * 3600) & (sod < 18 * 3600), 900, 100),
+}
+
+def generate_samples(days=14, days_trend_factor=1.1, off_hours_factor=0, jitter=.05, resolution_seconds=300,
+                     shape="sawtooth", weekend_factor=1.0, outliers=0.0, outlier_factor=3.0, scale=1.0,
+                     end: date | None = None, seed=None) -> tuple[np.ndarray, np.ndarray]:
+    # (epoch seconds, values) of days - 1 whole days (UTC) ending with the day before end (today by default),
+    # value = (day * days_trend_factor + shape(time of day) +- jitter), times off_hours_factor before 8am
+    # and weekend_factor on weekends, a fraction of outliers is multiplied by outlier_factor
+    if shape not in shapes:
+        raise ValueError(f"Unknown shape {shape}, use one of {', '.join(shapes)}")
+    rng = np.random.default_rng(seed)
+    end = end or date.today()
+    start = datetime.combine(end - timedelta(days=days - 1), datetime.min.time(), tzinfo=timezone.utc)
+    start_ts = int(start.timestamp())
+    points = max(days - 1, 0) * 86400 // resolution_seconds
+    ts = start_ts + np.arange(points, dtype=np.int64) * resolution_seconds
+    day = 1 + (ts - start_ts) // 86400
+    sod = ts % 86400
+    base = shapes[shape](sod).astype(np.float64)
+    values = day * days_trend_factor + rng.uniform(base * (1 - jitter), base * (1 + jitter))
+    values = np.where(sod < 8 * 3600, values * off_hours_factor, values)
+    # 1970-01-01 was a Thursday, so days 2 and 3 of the week are Saturday and Sunday
+    weekend = ((ts // 86400) % 7 >= 2) & ((ts // 86400) % 7 <= 3)
+    values = np.where(weekend, values * weekend_factor, values)
+    if outliers > 0:
+        values = np.where(rng.random(points) < outliers, values * outlier_factor, values)
+    return ts, values * scale
+
+if __name__ == "__main__":
+    # e.g. 90 days of minute data for 200 models: python -m app.sample_utils --models 200 --days 90 --resolution 60
+    from .db_utils import init_database, insert_samples
+    parser = argparse.ArgumentParser(description="Generates synthetic metrics into DB_FILE")
+    parser.add_argument("--models", type=int, default=1, help="number of models")
+    parser.add_argument("--prefix", default="sample-", help="model names are prefix + index")
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--resolution", type=int, default=300, help="seconds between the samples")
+    parser.add_argument("--shape", default="sawtooth", choices=list(shapes))
+    parser.add_argument("--trend", type=float, default=1.1, help="added per day")
+    parser.add_argument("--off-hours-factor", type=float, default=1.0)
+    parser.add_argument("--weekend-factor", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=.05)
+    parser.add_argument("--outliers", type=float, default=0.0, help="fraction of the samples")
+    parser.add_argument("--outlier-factor", type=float, default=3.0)
+    parser.add_argument("--vary", action="store_true", help="scale each model by a random factor in 0.5..2")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    init_database()
+    start = time.perf_counter()
+    rows = 0
+    for i in range(args.models):
+        seed = None if args.seed is None else args.seed + i
+        ts, values = generate_samples(
+            days=args.days,
+            days_trend_factor=args.trend,
+            off_hours_factor=args.off_hours_factor,
+            jitter=args.jitter,
+            resolution_seconds=args.resolution,
+            shape=args.shape,
+            weekend_factor=args.weekend_factor,
+            outliers=args.outliers,
+            outlier_factor=args.outlier_factor,
+            scale=np.random.default_rng(seed).uniform(.5, 2) if args.vary else 1.0,
+            seed=seed,
+        )
+        insert_samples(f"{args.prefix}{i}", ts, values)
+        rows += len(ts)
+        sys.stdout.write(f"\r{i + 1}/{args.models} models")
+        sys.stdout.flush()
+    print(f"\n✅ {rows} records were inserted into db in {time.perf_counter() - start:.1f}s.")
@@ -0,0 +1,126 @@
+import os
+import time
+import fcntl
+import random
+import threading
+import traceback
+from .model_utils import models_path
+from .db_utils import list_ingested
+from .job_utils import submit_retrain, last_fit_time, list_jobs
+
+# retrains only the models that went stale, instead of retraining all of them from a CronJob (example/model-retrainer.yaml)
+scheduler_interval = float(os.getenv("RETRAIN_SCHEDULER_INTERVAL", "60")) # seconds between the checks, 0 = off
+retrain_min_rows = int(os.getenv("RETRAIN_MIN_ROWS", "1000"))
+retrain_max_age_hours = float(os.getenv("RETRAIN_MAX_AGE_HOURS", "24"))
+retrain_min_interval = float(os.getenv("RETRAIN_MIN_INTERVAL_SECONDS", "600"))
+retrain_max_drift = float(os.getenv("RETRAIN_MAX_DRIFT", "0"))
+# scheduled fits that may be queued or running at once, so that the service keeps some CPU for serving
+retrain_max_concurrent = int(os.getenv("RETRAIN_MAX_CONCURRENT", "1"))
+# due models are retrained after a random delay, so that models fed by the same source don't all retrain at once
+retrain_jitter = float(os.getenv("RETRAIN_JITTER_SECONDS", "30"))
+# only the worker holding this lock schedules, flock doesn't work across hosts on some network file systems
+lock_file = os.getenv("RETRAIN_SCHEDULER_LOCK", os.path.join(models_path, ".scheduler.lock"))
+
+# model name -> forecast error drift (or None if unknown), compared with RETRAIN_MAX_DRIFT
+drift_provider = None
+
+lock_fd = None
+due = {} # model name -> (due at, reasons)
+attempted = {}
+last_check = None
+
+def set_drift_provider(provider):
+    global drift_provider
+    drift_provider = provider
+
+def acquire_leadership() -> bool:
+    global lock_fd
+    if lock_fd is not None:
+        return True
+    os.makedirs(os.path.dirname(lock_file) or ".", exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    # held until the process exits
+    lock_fd = fd
+    print(f"✅ Retrain scheduler is running in this worker (pid {os.getpid()})")
+    return True
+
+def retrain_reasons(name, ingested: int, now: float) -> list[str]:
+    fitted = last_fit_time(name)
+    if now - max(fitted, attempted.get(name, 0)) < retrain_min_interval:
+        return []
+    reasons = []
+    if retrain_min_rows > 0 and ingested >= retrain_min_rows:
+        reasons.append(f"{ingested} new rows")
+    if ingested > 0 and retrain_max_age_hours > 0 and now - fitted >= retrain_max_age_hours * 3600:
+        reasons.append("never fitted" if not fitted else f"fitted {(now - fitted) / 3600:.1f}h ago")
+    if retrain_max_drift > 0 and drift_provider is not None and fitted:
+        drift = drift_provider(name)
+        if drift is not None and drift >= retrain_max_drift:
+            reasons.append(f"drift {drift:.3f}")
+    return reasons
+
+def outstanding() -> int:
+    return sum(1 for j in list_jobs() if j.kind == "scheduled" and j.state in ("queued", "running"))
+
+def check(now: float | None = None) -> list[str]:
+    # submits the due models within the budget, returns their names
+    global last_check
+    now = now or time.time()
+    ingested = list_ingested()
+    for name in list(due):
+        if name not in ingested:
+            del due[name]
+    for name, count in ingested.items():
+        if name not in due:
+            reasons = retrain_reasons(name, count, now)
+            if reasons:
+                due[name] = (now + random.uniform(0, retrain_jitter), reasons)
+    budget = retrain_max_concurrent - outstanding()
+    submitted = []
+    for name, (due_at, reasons) in sorted(due.items(), key=lambda item: item[1][0]):
+        if budget <= 0 or due_at > now:
+            break
+        job = submit_retrain(name, kind="scheduled")
+        print(f"Retraining model {name} ({', '.join(reasons)}), job {job.id}")
+        del due[name]
+        attempted[name] = now
+        submitted.append(name)
+        budget -= 1
+    last_check = now
+    return submitted
+
+def start_scheduler():
+    if scheduler_interval <= 0:
+        return
+    def loop():
+        while True:
+            time.sleep(scheduler_interval * random.uniform(.9, 1.1))
+            try:
+                if acquire_leadership():
+                    check()
+            except Exception:
+                print(traceback.format_exc())
+    threading.Thread(target=loop, name="retrain-scheduler", daemon=True).start()
+
+def scheduler_stats() -> dict:
+    now = time.time()
+    return {
+        "enabled": scheduler_interval > 0,
+        "leader": lock_fd is not None,
+        "last_check_seconds_ago": round(now - last_check, 1) if last_check else None,
+        "outstanding": outstanding(),
+        "due": [{"model": name, "in_seconds": round(max(due_at - now, 0), 1), "reasons": reasons} for name, (due_at, reasons) in due.items()],
+        "thresholds": {
+            "min_rows": retrain_min_rows,
+            "max_age_hours": retrain_max_age_hours,
+            "min_interval_seconds": retrain_min_interval,
+            "max_drift": retrain_max_drift if drift_provider is not None else None,
+            "max_concurrent": retrain_max_concurrent,
+            "jitter_seconds": retrain_jitter,
+        },
+    }
@@ -0,0 +1,192 @@
+import io
+import os
+import sys
+import json
+import mmap
+import glob
+import time
+import pickle
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+# bump when the layout of the bundle changes
+bundle_version = 1
+
+# same as prophet.serialize.SIMPLE_ATTRIBUTES
+simple_attributes = [
+    'growth', 'n_changepoints', 'specified_changepoints', 'changepoint_range',
+    'yearly_seasonality', 'weekly_seasonality', 'daily_seasonality',
+    'seasonality_mode', 'seasonality_prior_scale', 'changepoint_prior_scale',
+    'holidays_prior_scale', 'mcmc_samples', 'interval_width', 'uncertainty_samples',
+    'y_scale', 'y_min', 'scaling', 'logistic_floor', 'country_holidays', 'component_modes',
+    'holidays_mode',
+]
+param_names = ["k", "m", "delta", "beta", "sigma_obs"]
+# the last couple of history rows, Prophet needs the spacing of the history in a few places (plot_components, uncertainty of 1-period forecasts)
+history_tail = 2
+
+def to_json_value(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"{type(o).__name__} is not serializable")
+
+def model_to_bundle(model) -> dict[str, np.ndarray]:
+    # only what is needed for predictions: parameters, seasonalities, changepoints and scaling
+    if model.history is None:
+        raise ValueError("Only a fitted model can be serialized.")
+    if model.holidays is not None:
+        raise ValueError("Models with holidays can't be serialized into a bundle.")
+    from prophet import __version__ as prophet_version
+    meta = {a: getattr(model, a) for a in simple_attributes}
+    meta.update({
+        "bundle_version": bundle_version,
+        "prophet_version": prophet_version,
+        "start": model.start.value,
+        "t_scale": model.t_scale.value,
+        "seasonalities": list(model.seasonalities.items()),
+        "extra_regressors": [(n, {**p, "predictor": None}) for n, p in model.extra_regressors.items()],
+        "train_holiday_names": None if model.train_holiday_names is None else list(model.train_holiday_names),
+        "component_cols": list(model.train_component_cols.columns),
+        "component_rows": list(model.train_component_cols.index),
+        "fit_stats": getattr(model, "fit_stats", None),
+    })
+    tail = model.history.tail(history_tail)
+    arrays = {
+        "meta": np.frombuffer(json.dumps(meta, default=to_json_value).encode("utf-8"), dtype=np.uint8),
+        "changepoints_t": np.asarray(model.changepoints_t, dtype=np.float64),
+        "changepoints": model.changepoints.values.astype("datetime64[ns]").astype(np.int64),
+        "component_matrix": model.train_component_cols.values.astype(np.int64),
+        "history_ds": tail["ds"].values.astype("datetime64[ns]").astype(np.int64),
+        "history_y": tail["y"].values.astype(np.float64),
+        "history_t": tail["t"].values.astype(np.float64),
+    }
+    for p in param_names:
+        arrays[f"params_{p}"] = np.asarray(model.params[p], dtype=np.float64)
+    return arrays
+
+def save_bundle(model, path):
+    # uncompressed, so that the arrays can be memory-mapped straight from the file
+    with open(path, "wb") as f:
+        np.savez(f, **model_to_bundle(model))
+
+def read_bundle(path) -> tuple[dict, dict[str, np.ndarray]]:
+    # the arrays are read-only views of the memory-mapped file
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path}: {info.filename} is compressed")
+            # local file header is 30 bytes followed by the file name and the extra field
+            name_len, extra_len = struct.unpack("<HH", mm[info.header_offset + 26:info.header_offset + 30])
+            start = info.header_offset + 30 + name_len + extra_len
+            header = io.BytesIO(mm[start:start + min(info.file_size, 65536)])
+            major, _ = np.lib.format.read_magic(header)
+            if major == 1:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+            count = int(np.prod(shape)) if shape else 1
+            array = np.frombuffer(mm, dtype=dtype, count=count, offset=start + header.tell())
+            arrays[info.filename.removesuffix(".npy")] = array.reshape(shape, order="F" if fortran_order else "C")
+    meta = json.loads(arrays.pop("meta").tobytes().decode("utf-8"))
+    if meta["bundle_version"] > bundle_version:
+        raise ValueError(f"{path}: unsupported bundle version {meta['bundle_version']}")
+    return meta, arrays
+
+class BundleModel:
+    # the attributes of a fitted Prophet model, enough for the fast path (predict_utils) without importing Prophet,
+    # to_prophet() turns it into a Prophet model for everything else (Prophet.predict, plots). Only plain values and
+    # the memory-mapped arrays are kept here, the pandas objects are built by to_prophet() as the fast path doesn't use them
+    train_holiday_names = None
+    holidays = None
+
+def to_prophet(model):
+    if not isinstance(model, BundleModel):
+        return model
+    from prophet import Prophet
+    full = Prophet()
+    attributes = vars(model).copy()
+    meta, arrays = attributes.pop("meta"), attributes.pop("arrays")
+    del attributes["component_terms"]
+    full.__dict__.update(attributes)
+    full.changepoints = pd.Series(pd.to_datetime(arrays["changepoints"]), name="ds")
+    if meta["train_holiday_names"] is not None:
+        full.train_holiday_names = pd.Series(meta["train_holiday_names"])
+    cols = pd.DataFrame(arrays["component_matrix"], columns=meta["component_cols"], index=meta["component_rows"])
+    cols.columns.name = "component"
+    cols.index.name = "col"
+    full.train_component_cols = cols
+    full.history = pd.DataFrame({
+        "ds": pd.to_datetime(arrays["history_ds"]),
+        "y": arrays["history_y"],
+        "t": arrays["history_t"],
+    })
+    return full
+
+def model_from_bundle(meta: dict, arrays: dict[str, np.ndarray]) -> BundleModel:
+    model = BundleModel()
+    model.meta = meta
+    model.arrays = arrays
+    for a in simple_attributes:
+        setattr(model, a, meta[a])
+    model.start = pd.Timestamp(meta["start"])
+    model.t_scale = pd.Timedelta(meta["t_scale"])
+    model.changepoints_t = arrays["changepoints_t"]
+    model.seasonalities = OrderedDict((n, p) for n, p in meta["seasonalities"])
+    model.extra_regressors = OrderedDict((n, p) for n, p in meta["extra_regressors"])
+    if meta["train_holiday_names"] is not None:
+        model.train_holiday_names = meta["train_holiday_names"]
+    # columns of train_component_cols
+    model.component_terms = {c: arrays["component_matrix"][:, i] for i, c in enumerate(meta["component_cols"])}
+    model.params = {p: arrays[f"params_{p}"] for p in param_names}
+    model.fit_stats = meta["fit_stats"]
+    model.stan_backend = None
+    return model
+
+def load_bundle_model(path):
+    return model_from_bundle(*read_bundle(path))
+
+def compare_formats(model, bundle_path) -> str:
+    # size and load time of the bundle vs. the pickle of the same model
+    pickled = pickle.dumps(model)
+    start = time.perf_counter()
+    pickle.loads(pickled)
+    pickle_load = time.perf_counter() - start
+    start = time.perf_counter()
+    load_bundle_model(bundle_path)
+    bundle_load = time.perf_counter() - start
+    size = os.path.getsize(bundle_path)
+    return (f"bundle: {size} B, loaded in {bundle_load * 1000:.1f} ms | "
+            f"pickle: {len(pickled)} B, loaded in {pickle_load * 1000:.1f} ms | "
+            f"{len(pickled) / size:.1f}x smaller")
+
+def convert(pickle_path, delete=False) -> str:
+    # publishes the bundle as the current version of the model, the pickle is moved aside unless it's deleted
+    from .store_utils import publish
+    models_dir, file_name = os.path.split(pickle_path)
+    name = file_name.removeprefix("prophet-").removesuffix(".pkl")
+    with open(pickle_path, "rb") as f:
+        model = pickle.load(f)
+    keep = f"{pickle_path}.bak"
+    if not delete:
+        os.replace(pickle_path, keep)
+    bundle_path = publish(models_dir or ".", name, "npz", lambda p: save_bundle(model, p))
+    print(f"✅ {pickle_path} -> {bundle_path} ({compare_formats(model, bundle_path)})")
+    return bundle_path
+
+if __name__ == "__main__":
+    # converts pickled models to bundles, e.g.: python -m app.serialize_utils [--delete] model/
+    args = sys.argv[1:]
+    delete = "--delete" in args
+    paths = [a for a in args if a != "--delete"] or [os.getenv("MODELS_PATH", "model/")]
+    for p in paths:
+        for f in (sorted(glob.glob(os.path.join(p, "prophet-*.pkl"))) if os.path.isdir(p) else [p]):
+            try:
+                convert(f, delete=delete)
+            except Exception as e:
+                print(f"Unable to convert {f}: {e}")
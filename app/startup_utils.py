@@ -0,0 +1,44 @@
+import os
+import time
+import traceback
+from contextlib import contextmanager
+
+# comma separated model names or * for all the models in MODELS_PATH, loaded (with their forecast grid) before /readiness is green
+preload_models = [m.strip() for m in os.getenv("PRELOAD_MODELS", "").split(",") if m.strip()]
+
+# (phase, seconds) of the startup, in order
+phases = []
+
+def record_phase(name, seconds: float):
+    phases.append((name, seconds))
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+def preload(names: list[str], models_dir) -> dict:
+    # a failing model doesn't block the readiness, it's loaded on the first request again
+    from .store_utils import current_models
+    from .grid_utils import refresh_grid
+    if names == ["*"]:
+        names = sorted(current_models(models_dir))
+    loaded, failed = [], []
+    with phase("preload"):
+        for name in names:
+            try:
+                refresh_grid(name)
+                loaded.append(name)
+            except Exception:
+                print(traceback.format_exc())
+                failed.append(name)
+    return {"loaded": loaded, "failed": failed}
+
+def startup_report() -> dict:
+    return {
+        "phases": [{"phase": name, "seconds": round(seconds, 4)} for name, seconds in phases],
+        "total_seconds": round(sum(seconds for _, seconds in phases), 4),
+    }
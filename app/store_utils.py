@@ -0,0 +1,133 @@
+import os
+import re
+import glob
+import time
+import threading
+import traceback
+
+# Models are published as immutable, versioned files (prophet-{name}.v{version}.{npz|pkl}) and a small pointer file
+# (prophet-{name}.current) holding the name of the current version. Both are written to a temp file and renamed,
+# so readers (in any worker process) see either the old or the new model, never a partially written one.
+# Files from before the versioning (prophet-{name}.npz/.pkl) are still read when there's no pointer.
+
+# older versions are kept for a while, a reader may have resolved the pointer just before it was switched
+keep_versions = int(os.getenv("MODEL_KEEP_VERSIONS", "3"))
+watch_interval = float(os.getenv("MODEL_WATCH_INTERVAL", "2"))
+
+version_re = re.compile(r".+\.v\d{20}\.(npz|pkl)")
+
+def pointer_file(models_dir, name):
+    return os.path.join(models_dir, f"prophet-{name}.current")
+
+def legacy_files(models_dir, name):
+    return [os.path.join(models_dir, f"prophet-{name}.npz"), os.path.join(models_dir, f"prophet-{name}.pkl")]
+
+def version_files(models_dir, name) -> list[str]:
+    # oldest first, the versions are zero-padded nanosecond timestamps
+    # the glob also matches the models whose names start with "{name}.v", the exact basename is checked
+    pattern = os.path.join(glob.escape(models_dir), f"prophet-{glob.escape(name)}.v*")
+    exact = re.compile(re.escape(f"prophet-{name}") + r"\.v\d{20}\.(npz|pkl)")
+    return sorted(p for p in glob.glob(pattern) if exact.fullmatch(os.path.basename(p)))
+
+def resolve(models_dir, name) -> str | None:
+    # path of the current version of a model or None
+    try:
+        with open(pointer_file(models_dir, name)) as f:
+            return os.path.join(models_dir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    for p in legacy_files(models_dir, name):
+        if os.path.exists(p):
+            return p
+    return None
+
+def write_atomically(path, write):
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        write(tmp)
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def publish(models_dir, name, ext, write) -> str:
+    # write(path) serializes the model, returns the path of the new version
+    os.makedirs(models_dir, exist_ok=True)
+    path = os.path.join(models_dir, f"prophet-{name}.v{time.time_ns():020d}.{ext}")
+    write_atomically(path, write)
+    def write_pointer(tmp):
+        with open(tmp, "w") as f:
+            f.write(os.path.basename(path))
+    write_atomically(pointer_file(models_dir, name), write_pointer)
+    for p in legacy_files(models_dir, name):
+        if os.path.exists(p):
+            os.remove(p)
+    prune(models_dir, name, keep_versions)
+    return path
+
+def prune(models_dir, name, keep: int):
+    # processes that have the removed files memory-mapped keep reading them until they unmap them
+    for p in version_files(models_dir, name)[:-keep] if keep > 0 else []:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+def remove_all(models_dir, name) -> list[str]:
+    removed = []
+    for p in [pointer_file(models_dir, name)] + version_files(models_dir, name) + legacy_files(models_dir, name):
+        try:
+            os.remove(p)
+            removed.append(p)
+        except FileNotFoundError:
+            pass
+    return removed
+
+def current_models(models_dir) -> dict[str, str]:
+    # name -> path of the current version, for all the models in the directory
+    models = {}
+    try:
+        entries = list(os.scandir(models_dir))
+    except FileNotFoundError:
+        return models
+    for entry in entries:
+        if not entry.name.startswith("prophet-"):
+            continue
+        base = entry.name.removeprefix("prophet-")
+        if base.endswith(".current"):
+            path = resolve(models_dir, base.removesuffix(".current"))
+            if path is not None:
+                models[base.removesuffix(".current")] = path
+        elif base.endswith((".npz", ".pkl")) and not version_re.fullmatch(base):
+            models.setdefault(base[:-4], entry.path)
+    return models
+
+def pointer_state(models_dir) -> dict[str, tuple]:
+    state = {}
+    try:
+        for entry in os.scandir(models_dir):
+            if entry.name.startswith("prophet-") and entry.name.endswith(".current"):
+                st = entry.stat()
+                state[entry.name.removeprefix("prophet-").removesuffix(".current")] = (st.st_ino, st.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return state
+
+def start_watcher(models_dir, on_change):
+    # notifies this process about models published (or deleted) by other processes, on_change(name) is called for each
+    def loop():
+        known = pointer_state(models_dir)
+        while True:
+            time.sleep(watch_interval)
+            try:
+                current = pointer_state(models_dir)
+                for name in set(known) | set(current):
+                    if known.get(name) != current.get(name):
+                        on_change(name)
+                known = current
+            except Exception:
+                print(traceback.format_exc())
+    if watch_interval > 0:
+        threading.Thread(target=loop, name="model-watcher", daemon=True).start()
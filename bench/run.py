@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import pickle
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+from types import SimpleNamespace
+from datetime import datetime
+
+# python -m bench.run [--quick] [--out results.json] [--compare previous.json]
+# runs against a temporary DB_FILE and MODELS_PATH, so it has to be configured before the app is imported
+
+def percentiles(samples: list[float]) -> dict:
+    ms = sorted(s * 1000 for s in samples)
+    pick = lambda p: ms[min(len(ms) - 1, int(round(p / 100 * (len(ms) - 1))))]
+    return {"p50_ms": round(pick(50), 3), "p90_ms": round(pick(90), 3), "p99_ms": round(pick(99), 3), "mean_ms": round(statistics.fmean(ms), 3), "runs": len(ms)}
+
+def timed(fn, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def bench_ingestion(rows: int) -> dict:
+    from app.db_utils import insert_measurement, insert_measurements, insert_samples
+    from app.sample_utils import generate_samples
+    single = min(rows, 2000)
+    start = time.perf_counter()
+    for i in range(single):
+        insert_measurement("ingest-single", datetime.fromtimestamp(1_700_000_000 + i * 60), float(i))
+    single_rate = single / (time.perf_counter() - start)
+    batch = [("ingest-batch", datetime.fromtimestamp(1_700_000_000 + i * 60), float(i)) for i in range(rows)]
+    start = time.perf_counter()
+    insert_measurements(batch)
+    batch_rate = rows / (time.perf_counter() - start)
+    ts, values = generate_samples(days=rows * 60 // 86400 + 2, resolution_seconds=60, seed=0)
+    start = time.perf_counter()
+    insert_samples("ingest-bulk", ts, values)
+    bulk_rate = len(ts) / (time.perf_counter() - start)
+    return {
+        "single_rows_per_s": round(single_rate),
+        "batch_rows_per_s": round(batch_rate),
+        "bulk_rows_per_s": round(bulk_rate),
+    }
+
+def bench_model(name: str, days: int, resolution: int, runs: int) -> dict:
+    from app import model_utils
+    from app.serialize_utils import to_prophet
+    from app.db_utils import insert_samples, load_training_data, parseModelParams, get_model
+    from app.sample_utils import generate_samples
+    ts, values = generate_samples(days=days, resolution_seconds=resolution, shape="sine", jitter=.1, seed=1)
+    insert_samples(name, ts, values)
+    params = parseModelParams(get_model(name))
+    df = load_training_data(name, params)
+    fit = model_utils.train_and_save(name, params, df)
+    path = model_utils.model_file(name)
+    model = model_utils.load_model(name)
+    pickled = pickle.dumps(to_prophet(model))
+
+    def cold_load():
+        model_utils.model_cache.clear()
+        model_utils.load_model(name)
+
+    start = datetime.today().strftime("%Y-%m-%d %H:00:00")
+    result = {
+        "rows": len(df),
+        "fit_seconds": fit["fit_seconds"],
+        "iterations": fit["iterations"],
+        "model_bytes": os.path.getsize(path),
+        "pickle_bytes": len(pickled),
+        "load": timed(cold_load, runs),
+        "pickle_load": timed(lambda: pickle.loads(pickled), runs),
+        "predict_24": timed(lambda: model_utils.generate_forecast(start, 24, name), runs),
+        "predict_1000": timed(lambda: model_utils.generate_forecast(start, 1000, name), runs),
+        "predict_24_prophet": timed(lambda: model_utils.generate_forecast(start, 24, name, fast=False), max(runs // 10, 3)),
+        "graph": timed(lambda: model_utils.generate_graph_bytes(None, start, True, True, False, 60, name, "10min"), max(runs // 10, 3)),
+    }
+    return result
+
+def train_small(name: str, seed: int):
+    from app.model_utils import train_and_save
+    from app.db_utils import insert_samples, load_training_data, parseModelParams, get_model
+    from app.sample_utils import generate_samples
+    ts, values = generate_samples(days=7, resolution_seconds=900, shape="sine", scale=1 + seed / 10, seed=seed)
+    insert_samples(name, ts, values)
+    params = parseModelParams(get_model(name))
+    train_and_save(name, params, load_training_data(name, params))
+
+def bench_batch(names: list[str], runs: int) -> dict:
+    from app.batch_utils import forecast_batch
+    start = datetime.today().strftime("%Y-%m-%d %H:00:00")
+    items = [SimpleNamespace(model=n, start_date=start, periods=24, freq="h") for n in names]
+    return {"models": len(names), **timed(lambda: forecast_batch(items), runs)}
+
+def compare(current: dict, previous: dict, prefix=""):
+    # prints the relative change of every numeric value that's in both results
+    for key, value in current.items():
+        other = previous.get(key) if isinstance(previous, dict) else None
+        if isinstance(value, dict):
+            compare(value, other or {}, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and isinstance(other, (int, float)) and other:
+            print(f"{prefix}{key}: {other} -> {value} ({(value - other) / other * 100:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks training, prediction, ingestion and rendering")
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller series")
+    parser.add_argument("--runs", type=int, default=None, help="repetitions of the latency measurements")
+    parser.add_argument("--out", default=None, help="defaults to bench/results/<time>-<commit>.json")
+    parser.add_argument("--compare", default=None, help="previous results to compare with")
+    args = parser.parse_args()
+    runs = args.runs or (20 if args.quick else 100)
+    # (days, resolution seconds) of the series, the number of rows is roughly days * 86400 / resolution
+    series = [(7, 600), (14, 300)] if args.quick else [(7, 600), (30, 300), (60, 60)]
+    batch_models = 10 if args.quick else 50
+
+    tmp = tempfile.mkdtemp(prefix="keda-prophet-bench-")
+    os.environ["DB_FILE"] = os.path.join(tmp, "bench.sqlite")
+    os.environ["MODELS_PATH"] = os.path.join(tmp, "models")
+    from app.db_utils import init_database
+    init_database()
+
+    commit = git_commit()
+    results = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+            "runs": runs,
+        },
+        "ingestion": bench_ingestion(20_000 if args.quick else 200_000),
+        "models": {},
+    }
+    for days, resolution in series:
+        name = f"bench-{days}d-{resolution}s"
+        results["models"][name] = bench_model(name, days, resolution, runs)
+    names = [f"bench-batch-{i}" for i in range(batch_models)]
+    for i, name in enumerate(names):
+        train_small(name, seed=i)
+    results["batch_predict"] = bench_batch(names, runs)
+
+    out = args.out or os.path.join("bench", "results", f"{datetime.now():%Y%m%d-%H%M%S}-{(commit or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"✅ Results were written to {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import sqlite3
+from app import accuracy_utils
+from app.db_utils import series_tables_q
+
+def connect():
+    con = sqlite3.connect(":memory:")
+    for statement in series_tables_q:
+        con.execute(statement)
+    return con
+
+def test_forecasts_beyond_the_ring_buffer_are_not_recorded():
+    # 48 hourly periods, the ring buffer spans 24h with the defaults
+    con = connect()
+    now = 1_700_000_000 // 3600 * 3600
+    targets = [now + h * 3600 for h in range(1, 49)]
+    recorded = accuracy_utils.record(con, "m", targets, [float(h) for h in range(1, 49)], now)
+    span = accuracy_utils.forecast_log_slots * accuracy_utils.forecast_log_step
+    assert recorded == sum(1 for t in targets if t - now < span)
+    buckets = [row[0] for row in con.execute("SELECT bucket FROM forecasts WHERE name = 'm' ORDER BY bucket")]
+    assert buckets == [t // accuracy_utils.forecast_log_step for t in targets if t - now < span]
+    horizons = {row[0] for row in con.execute("SELECT DISTINCT horizon FROM forecasts")}
+    assert horizons == {3600, 6 * 3600, 24 * 3600}
+
+def test_nearer_forecasts_are_scored():
+    con = connect()
+    now = 1_700_000_000 // 3600 * 3600
+    targets = [now + h * 3600 for h in range(1, 49)]
+    accuracy_utils.record(con, "m", targets, [10.0] * 48, now)
+    assert accuracy_utils.join_actuals(con, "m", [now + 3600, now + 2 * 3600], [8.0, 12.0], now + 2 * 3600) == 2
+    stats = accuracy_utils.summarize(con.execute(accuracy_utils.get_errors_q, ("m",)).fetchall())
+    assert [(s["horizon_seconds"], s["count"], s["mae"]) for s in stats] == [(3600, 1, 2.0), (6 * 3600, 1, 2.0)]
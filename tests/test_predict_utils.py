@@ -0,0 +1,34 @@
+import os
+import pickle
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import date
+from app.model_utils import build_model, get_default_model_params
+from app.predict_utils import FastPredictor, to_us
+from app.sample_utils import generate_samples
+
+model_path = os.path.join(os.path.dirname(__file__), "..", "model", "prophet-test.pkl")
+
+def assert_matches(model, start):
+    # off the minute grid, so that the timestamps don't line up with the training data
+    ds = pd.date_range(start, periods=24 * 60 * 3, freq="min") + pd.Timedelta("7s")
+    expected = model.predict(pd.DataFrame({"ds": ds}))["yhat"].values
+    actual = FastPredictor(model).predict(to_us(ds))
+    assert np.max(np.abs(actual - expected)) <= 1e-6 * max(1.0, np.max(np.abs(expected)))
+
+def test_matches_prophet():
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+    assert_matches(model, model.history["ds"].min())
+
+@pytest.mark.parametrize("mode", ["additive", "multiplicative"])
+def test_matches_prophet_with_seasonality_mode(mode):
+    logging.getLogger("cmdstanpy").disabled = True
+    ts, values = generate_samples(days=8, resolution_seconds=900, end=date(2025, 3, 1), seed=1)
+    params = get_default_model_params().model_copy(update={"seasonality_mode": mode})
+    model = build_model(params)
+    model.fit(pd.DataFrame({"ds": pd.to_datetime(ts, unit="s"), "y": values}))
+    assert FastPredictor(model).beta_mult.any() == (mode == "multiplicative")
+    assert_matches(model, "2025-03-01")